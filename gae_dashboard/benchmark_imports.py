@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""Time how long it takes to import each of the dashboard scripts.
+
+Every cron job pays this cost before doing any work, so we want to
+notice if it creeps up (e.g. if a module starts importing the App
+Engine SDK at import time again).  Each module is imported in a fresh
+python process several times, and we report the fastest and median
+times.
+
+Usage:
+  ./benchmark_imports.py [--runs N] [--log FILE] [MODULE ...]
+
+With --log, the results are also appended to FILE as a line of JSON,
+so they can be compared over time.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+
+
+_DEFAULT_MODULES = [
+    'dashboard_report',
+    'fetch_stats',
+    'gae_dashboard_curl',
+    'gae_dashboard_scrape',
+    'ka_report',
+    'load_usage_reports',
+    ]
+
+_TIMING_SCRIPT = ('import time; start = time.time(); import %s; '
+                  'print time.time() - start')
+
+
+def time_import(module, runs):
+    """Return a sorted list of import times, in seconds, for module."""
+    timings = []
+    for _ in xrange(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', _TIMING_SCRIPT % module],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        timings.append(float(output.strip().splitlines()[-1]))
+    return sorted(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', 1)[0])
+    parser.add_argument('--runs', type=int, default=5,
+                        help='times to import each module [default: '
+                             '%(default)s]')
+    parser.add_argument('--log', metavar='FILE',
+                        help='append the results to FILE as json')
+    parser.add_argument('modules', nargs='*', metavar='MODULE',
+                        default=_DEFAULT_MODULES,
+                        help='modules to time [default: all the scripts]')
+    args = parser.parse_args()
+
+    results = {}
+    for module in args.modules:
+        timings = time_import(module, args.runs)
+        results[module] = {'min': timings[0],
+                           'median': timings[len(timings) // 2]}
+        print '%-25s min %.3fs  median %.3fs' % (
+            module, results[module]['min'], results[module]['median'])
+
+    if args.log:
+        with open(args.log, 'a') as f:
+            print >>f, json.dumps({
+                'utc_datetime': datetime.datetime.utcnow().isoformat(),
+                'runs': args.runs,
+                'results': results,
+                }, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
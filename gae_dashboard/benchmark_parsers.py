@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+"""Time the parsers in parsers.py on the saved admin pages in fixtures/.
+
+Every public method of every parsers.BaseParser subclass is run on
+that class's fixture page, fixtures/<page>.html, where <page> is the
+class name in lower_case_with_underscores (the same naming that
+gae_dashboard_scrape.py uses for URLs).  Each method is timed
+parsing the page in full and, for classes that have one, with the
+fast=True path (which stops parsing once it has the data it needs,
+as gae_dashboard_scrape.py does), and we report the time taken
+and the increase in peak memory.  Class methods that read the page
+from a file as they go, like BillingHistory.iter_event_dicts(), are
+timed in a single 'stream' mode instead.  Each measurement is run in a fresh
+python process so they don't affect each other's peak memory.
+
+The fixture pages are anonymized copies of real admin pages.  When
+App Engine changes a page, save a new copy (replacing app ids, version
+names, instance ids, etc) and check that the parsers still work.
+
+Usage:
+  ./benchmark_parsers.py [--runs N] [--log FILE]
+  ./benchmark_parsers.py --save_baseline FILE
+  ./benchmark_parsers.py --baseline FILE [--tolerance 0.25]
+
+With --log, the results are appended to FILE as a line of JSON, so
+they can be compared over time.  With --baseline, we exit with an
+error if any method's median time or peak memory is more than
+--tolerance (a fraction) worse than it was in the baseline file, as
+written by --save_baseline on the same machine.
+"""
+
+import argparse
+import datetime
+import inspect
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import time
+
+import parsers
+
+
+_FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'fixtures')
+
+# Timings this small are mostly noise, so we don't flag them as
+# regressions no matter how they change.
+_MIN_SECONDS_TO_COMPARE = 0.005
+
+
+def _fixture_name(parser_class):
+    """'InstanceSummary' -> 'instance_summary.html'."""
+    return re.sub(r'(?<!^)([A-Z])', r'_\1', parser_class.__name__).lower() + (
+        '.html')
+
+
+def _is_streaming(method):
+    """True if method is a class method that takes the page as a file."""
+    return (method.im_self is not None and
+            inspect.getargspec(method).args[1:2] == ['html_file'])
+
+
+def _modes(parser_class, method):
+    """The ways to run this method: ['stream'], ['full'], or both
+    ['full', 'fast'] if the class has a fast path."""
+    if _is_streaming(getattr(parser_class, method)):
+        return ['stream']
+    if parser_class._LAST_NEEDED_ID is None:
+        return ['full']
+    return ['full', 'fast']
+
+
+def cases():
+    """Return (fixture, parser class name, method name) for each benchmark.
+
+    Parser classes without a fixture page are skipped.
+    """
+    retval = []
+    for (class_name, parser_class) in sorted(vars(parsers).items()):
+        if not (inspect.isclass(parser_class) and
+                issubclass(parser_class, parsers.BaseParser) and
+                parser_class is not parsers.BaseParser):
+            continue
+        fixture = _fixture_name(parser_class)
+        if not os.path.exists(os.path.join(_FIXTURE_DIR, fixture)):
+            continue
+        for (method, _) in inspect.getmembers(parser_class,
+                                              inspect.ismethod):
+            if not method.startswith('_'):
+                retval.append((fixture, class_name, method))
+    return retval
+
+
+def _run_case(fixture, parser_class_name, method, mode, runs):
+    """Parse fixture runs times; return (timings in seconds, peak rss kb)."""
+    fixture_path = os.path.join(_FIXTURE_DIR, fixture)
+    parser_class = getattr(parsers, parser_class_name)
+    if mode == 'stream':
+        contents = None
+    else:
+        with open(fixture_path) as f:
+            contents = f.read()
+
+    start_maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timings = []
+    for _ in xrange(runs):
+        start = time.time()
+        if mode == 'stream':
+            with open(fixture_path) as f:
+                value = list(getattr(parser_class, method)(f))
+        else:
+            parser = parser_class(contents, fast=(mode == 'fast'))
+            value = getattr(parser, method)()
+        if hasattr(value, 'next'):
+            value = list(value)    # unpack generator
+        timings.append(time.time() - start)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return (sorted(timings), maxrss - start_maxrss)
+
+
+def measure(fixture, parser_class_name, method, mode, runs):
+    """Run _run_case() in a new python process and return its result."""
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--child',
+         json.dumps([fixture, parser_class_name, method, mode, runs])])
+    return json.loads(output)
+
+
+def find_regressions(results, baseline, tolerance):
+    """Return a list of messages about results worse than the baseline.
+
+    results and baseline both map a benchmark name to a dict with
+    'median_seconds' and 'peak_kb'.
+    """
+    regressions = []
+    for (name, result) in sorted(results.iteritems()):
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        if (result['median_seconds'] >= _MIN_SECONDS_TO_COMPARE and
+                result['median_seconds'] >
+                old['median_seconds'] * (1 + tolerance)):
+            regressions.append('%s: median time %.2fms, was %.2fms'
+                               % (name, result['median_seconds'] * 1000,
+                                  old['median_seconds'] * 1000))
+        # Peak memory is measured in pages, so allow a little slack.
+        if result['peak_kb'] > old['peak_kb'] * (1 + tolerance) + 64:
+            regressions.append('%s: peak memory %dkb, was %dkb'
+                               % (name, result['peak_kb'], old['peak_kb']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n', 1)[0],
+        epilog=__doc__.split('\n\n', 1)[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=20,
+                        help='times to parse each page [default: %(default)s]')
+    parser.add_argument('--log', metavar='FILE',
+                        help='append the results to FILE as json')
+    parser.add_argument('--save_baseline', metavar='FILE',
+                        help='write the results to FILE for --baseline')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='fail if results are worse than those in FILE')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help=('how much worse than the baseline is too much, '
+                              'as a fraction [default: %(default)s]'))
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print json.dumps(_run_case(*json.loads(args.child)))
+        return 0
+
+    results = {}
+    print '%-50s %-6s %10s %10s %10s' % ('parser', 'mode', 'min ms',
+                                         'median ms', 'peak kb')
+    for (fixture, parser_class_name, method) in cases():
+        parser_class = getattr(parsers, parser_class_name)
+        for mode in _modes(parser_class, method):
+            (timings, peak_kb) = measure(fixture, parser_class_name, method,
+                                         mode, args.runs)
+            name = '%s.%s (%s)' % (parser_class_name, method, mode)
+            results[name] = {'min_seconds': timings[0],
+                             'median_seconds': timings[len(timings) // 2],
+                             'peak_kb': peak_kb}
+            print '%-50s %-6s %10.2f %10.2f %10d' % (
+                '%s.%s' % (parser_class_name, method),
+                mode,
+                results[name]['min_seconds'] * 1000,
+                results[name]['median_seconds'] * 1000,
+                peak_kb)
+
+    if args.log:
+        with open(args.log, 'a') as f:
+            print >>f, json.dumps({
+                'utc_datetime': datetime.datetime.utcnow().isoformat(),
+                'runs': args.runs,
+                'results': results,
+                }, sort_keys=True)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.tolerance)
+        if regressions:
+            print >>sys.stderr, 'REGRESSIONS:\n  %s' % '\n  '.join(
+                regressions)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,9 +2,21 @@
 
 import cPickle
 import datetime
+import itertools
 import json
+import marshal
+import mmap
 import os
+import socket
 import subprocess
+import uuid
+
+import apiclient.discovery
+import apiclient.errors
+import httplib2
+import oauth2client.client
+
+import state_util
 
 
 _DATA_DIRECTORY = os.path.join(os.getenv('HOME'), 'bq_data/')
@@ -15,16 +27,193 @@ def _get_data_filename(report, yyyymmdd):
 
     Takes a report name and a date stamp.  The file returned is not guaranteed
     to exist.
+
+    We used to store all data this way; now only data that isn't a table
+    (see _ColumnStore) is.
     """
     return os.path.join(_DATA_DIRECTORY, report + '_' + yyyymmdd + '.pickle')
 
 
-def get_daily_data(report, yyyymmdd):
+class _ColumnStore(object):
+    """All the saved tables for one report, stored by column.
+
+    A table is a list of dicts with the same keys, as returned from
+    query_bigquery.  For each day we store each column's values as a
+    marshaled list, appended to a data file, <report>.columns.
+    <report>.index is a JSON map saying where they are:
+
+       {yyyymmdd: {'num_rows': N, 'columns': [[name, offset, length], ...]}}
+
+    So to load some days of a report we read the small index, mmap the
+    data file, and unmarshal just the columns we want for those days.
+
+    If a day is saved again or discarded, its old columns are left in
+    the data file.  Once such dead space is most of the file, we copy
+    the live columns to a new data file, <report>.columns.<N>, and
+    record N in the index as '_generation'.  The index is only switched
+    to the new file once it's complete, so a crash leaves either the
+    old or the new file in use, never a mix.
+    """
+    def __init__(self, report):
+        self._path_prefix = os.path.join(_DATA_DIRECTORY, report)
+        self._index = state_util.State(self._path_prefix + '.index')
+
+    def _data_path(self, index):
+        """The data file that index's offsets are into."""
+        generation = index.get('_generation', 0)
+        if generation == 0:
+            return self._path_prefix + '.columns'
+        return '%s.columns.%d' % (self._path_prefix, generation)
+
+    @staticmethod
+    def is_table(data):
+        """True if data is a list of dicts that all have the same keys."""
+        if not isinstance(data, list):
+            return False
+        if not all(isinstance(row, dict) for row in data):
+            return False
+        return all(row.viewkeys() == data[0].viewkeys() for row in data)
+
+    def save(self, table, yyyymmdd):
+        """Save table, which must satisfy is_table(), for the given day.
+
+        Raises ValueError, without saving anything, if the table holds
+        a value that marshal can't store (only builtin types can be).
+        """
+        names = table[0].keys() if table else []
+        # We marshal everything before writing anything, so a bad
+        # value doesn't leave part of a table in the data file.
+        blobs = [marshal.dumps([row[name] for row in table])
+                 for name in names]
+        with self._index.locked():
+            index = self._index.read(default={})
+            columns = []
+            with open(self._data_path(index), 'ab') as f:
+                f.seek(0, os.SEEK_END)
+                for (name, blob) in zip(names, blobs):
+                    columns.append([name, f.tell(), len(blob)])
+                    f.write(blob)
+                f.flush()
+                os.fsync(f.fileno())
+            index[yyyymmdd] = {'num_rows': len(table), 'columns': columns}
+            self._write_index(index)
+
+    def discard(self, yyyymmdd):
+        """Forget the table saved for the given day, if any."""
+        if not os.path.exists(self._index.path):
+            return
+        with self._index.locked():
+            index = self._index.read(default={})
+            if index.pop(yyyymmdd, None) is not None:
+                self._write_index(index)
+
+    def _write_index(self, index):
+        """Write index, first compacting the data file if it's mostly dead.
+
+        The caller must hold self._index.locked().
+        """
+        data_path = self._data_path(index)
+        live_size = sum(length
+                        for (yyyymmdd, day) in index.iteritems()
+                        if yyyymmdd != '_generation'
+                        for (_, _, length) in day['columns'])
+        if (not os.path.exists(data_path) or
+                os.path.getsize(data_path) <= 2 * live_size):
+            self._index.write(index)
+            return
+
+        new_index = dict(index, _generation=index.get('_generation', 0) + 1)
+        new_data_path = self._data_path(new_index)
+        with open(data_path, 'rb') as old_f:
+            with open(new_data_path, 'wb') as new_f:
+                for yyyymmdd in sorted(index):
+                    if yyyymmdd == '_generation':
+                        continue
+                    new_columns = []
+                    for (name, offset, length) in index[yyyymmdd]['columns']:
+                        old_f.seek(offset)
+                        new_columns.append([name, new_f.tell(), length])
+                        new_f.write(old_f.read(length))
+                    new_index[yyyymmdd] = dict(index[yyyymmdd],
+                                               columns=new_columns)
+                new_f.flush()
+                os.fsync(new_f.fileno())
+        self._index.write(new_index)
+        # Readers that already opened the old file can still use it.
+        os.unlink(data_path)
+
+    def load(self, yyyymmdds, columns=None):
+        """Return a dict mapping each day in yyyymmdds to its table.
+
+        If columns is given, the tables' rows only have those keys.
+        Days with no saved table aren't in the returned dict.
+
+        Raises KeyError if a day's (non-empty) table doesn't have all
+        the given columns.
+        """
+        if not os.path.exists(self._index.path):
+            return {}
+        # We open the data file while holding the lock, so it's the
+        # one the index refers to even if the store is being compacted.
+        with self._index.locked():
+            index = self._index.read(default={})
+            days = [yyyymmdd for yyyymmdd in yyyymmdds
+                    if yyyymmdd in index and yyyymmdd != '_generation']
+            if not days:
+                return {}
+            f = open(self._data_path(index), 'rb')
+
+        tables = {}
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size:
+                data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            else:
+                # We can't mmap an empty file.  All the tables must be
+                # empty too.
+                data = ''
+            try:
+                for yyyymmdd in days:
+                    names = []
+                    values = []
+                    for (name, offset, length) in index[yyyymmdd]['columns']:
+                        if columns is None or name in columns:
+                            names.append(name)
+                            values.append(marshal.loads(
+                                data[offset:offset + length]))
+                    num_rows = index[yyyymmdd]['num_rows']
+                    missing_columns = set(columns or ()).difference(names)
+                    if num_rows and missing_columns:
+                        raise KeyError('%s has no column(s) %s for %s'
+                                       % (self._index.path,
+                                          sorted(missing_columns), yyyymmdd))
+                    if names:
+                        tables[yyyymmdd] = [dict(itertools.izip(names, row))
+                                            for row in itertools.izip(*values)]
+                    else:
+                        tables[yyyymmdd] = [{} for _ in xrange(num_rows)]
+            finally:
+                if size:
+                    data.close()
+        return tables
+
+
+def get_daily_data(report, yyyymmdd, columns=None):
     """Gets old data for a particular report.
 
     Returns the data in the format saved (see save_daily_data or the caller),
-    or None if there is no old data for that report on that day.
+    or None if there is no old data for that report on that day.  If the
+    data is a table (a list of dicts), and columns is given, each row only
+    has those keys.
     """
+    table = _ColumnStore(report).load([yyyymmdd], columns).get(yyyymmdd)
+    if table is not None:
+        return table
+    return _get_pickled_daily_data(report, yyyymmdd)
+
+
+def _get_pickled_daily_data(report, yyyymmdd):
+    """Like get_daily_data, for data not saved in the _ColumnStore."""
     filename = _get_data_filename(report, yyyymmdd)
     if not os.path.exists(filename):
         return None
@@ -39,13 +228,29 @@ def save_daily_data(data, report, yyyymmdd):
     This will create the relevant directories if they don't exist, and clobber
     any existing data with the same timestamp.  "data" can be anything
     pickleable, but in general will likely be of the format returned from
-    _query_bigquery, namely a list of dicts fieldname -> value.
+    _query_bigquery, namely a list of dicts fieldname -> value.  Data in
+    that format is stored by column (see _ColumnStore), unless it holds
+    values that aren't builtin types, like datetimes; then it's pickled.
     """
+    if not os.path.isdir(_DATA_DIRECTORY):
+        os.makedirs(_DATA_DIRECTORY)
     filename = _get_data_filename(report, yyyymmdd)
-    if not os.path.isdir(os.path.dirname(filename)):
-        os.makedirs(os.path.dirname(filename))
+    column_store = _ColumnStore(report)
+    if _ColumnStore.is_table(data):
+        try:
+            column_store.save(data, yyyymmdd)
+        except ValueError:      # marshal can't store some value
+            pass
+        else:
+            # Don't let an older pickle hide this data if the index is lost.
+            if os.path.exists(filename):
+                os.unlink(filename)
+            return
+
     with open(filename, 'w') as f:
         cPickle.dump(data, f)
+    # Don't let an older table hide this data.
+    column_store.discard(yyyymmdd)
 
 
 def get_daily_data_from_disk_or_bq(query, report, yyyymmdd):
@@ -66,19 +271,24 @@ def get_daily_data_from_disk_or_bq(query, report, yyyymmdd):
     return daily_data
 
 
-def process_past_data(report, end_date, history_length, keyfn):
+def process_past_data(report, end_date, history_length, keyfn, columns=None):
     """Get and process the past data for a particular report.
 
     Returns a list of dicts, one for each day, in most-recent-first order, with
     keys of the form returned by keyfn(row), and values the same type of rows
     returned by `bq`.  If there is no data, the dict will be empty.
     'history_length' is the number of days of data to include, not counting the
-    current one.
+    current one.  If 'columns' is given, we only load those columns of each
+    row, so it must include the ones keyfn uses.
     """
+    yyyymmdds = [(end_date - datetime.timedelta(i)).strftime("%Y%m%d")
+                 for i in xrange(history_length + 1)]
+    tables = _ColumnStore(report).load(yyyymmdds, columns)
     historical_data = []
-    for i in xrange(history_length + 1):
-        old_yyyymmdd = (end_date - datetime.timedelta(i)).strftime("%Y%m%d")
-        old_data = get_daily_data(report, old_yyyymmdd)
+    for old_yyyymmdd in yyyymmdds:
+        old_data = tables.get(old_yyyymmdd)
+        if old_data is None:
+            old_data = _get_pickled_daily_data(report, old_yyyymmdd)
         # Save it by url_route for easy lookup.
         if old_data:
             historical_data.append({keyfn(row): row for row in old_data})
@@ -92,11 +302,212 @@ def process_past_data(report, end_date, history_length, keyfn):
     return historical_data
 
 
-def query_bigquery(sql_query, retries=2):
+# The BigQuery API client, created on first use by _get_bigquery_service().
+_bigquery_service = None
+_bigquery_project_id = None
+
+# Rows are typed according to the query's schema.  Other types
+# (including STRING, even if the string looks like a number) are left
+# as the strings that BigQuery returns.
+_TYPE_CONVERTERS = {
+    'INTEGER': int,
+    'FLOAT': float,
+    # The API gives seconds since the epoch; the bq tool prints this.
+    'TIMESTAMP': lambda v: datetime.datetime.utcfromtimestamp(
+        float(v)).strftime('%Y-%m-%d %H:%M:%S'),
+}
+
+# The bq tool already prints timestamps the way we want them.
+_BQ_TOOL_TYPE_CONVERTERS = {
+    'INTEGER': int,
+    'FLOAT': float,
+}
+
+
+def _typed_column(field, values, converters=_TYPE_CONVERTERS):
+    """Convert one column of query results according to its schema.
+
+    Arguments:
+      field: the column's field from the query's schema: a dict with
+        its 'name' and 'type'.
+      values: a list of the column's values as strings (or None for
+        NULL).
+      converters: a dict from BigQuery type to the function that
+        converts a value of that type from a string.
+
+    Returns:
+      A list of the typed values, with NULLs replaced by '(None)'.
+    """
+    converter = converters.get(field['type'])
+    if converter is None:
+        return ['(None)' if v is None else v for v in values]
+    return ['(None)' if v is None else converter(v) for v in values]
+
+
+def _typed_rows(fields, columns, converters=_TYPE_CONVERTERS):
+    """Convert query results, stored by column, to a list of typed rows.
+
+    Arguments:
+      fields: the 'fields' of the query's schema: a list of dicts with
+        the 'name' and 'type' of each column.
+      columns: a list with, for each field, a list of that column's
+        values as strings (or None for NULL).
+      converters: as for _typed_column().
+
+    Returns:
+      A list of dicts, one per row, from field name to typed value.
+    """
+    typed_columns = [_typed_column(field, values, converters)
+                     for (field, values) in zip(fields, columns)]
+    names = [field['name'] for field in fields]
+    return [dict(itertools.izip(names, row))
+            for row in itertools.izip(*typed_columns)]
+
+
+def _get_bigquery_service():
+    """Return (BigQuery API client, project id), or (None, None).
+
+    This requires $HOME/bigquery_secret.json exist and hold the JSON
+    credentials for a Google Cloud Platform service account that can
+    run queries.  The project to run queries in is the one in those
+    credentials, or else the default project_id in $HOME/.bigqueryrc
+    (as written by 'bq init').  If we can't find either, we return
+    (None, None).
+
+    The client is created once per process, so all our queries share
+    its HTTP connection.
+    """
+    global _bigquery_service, _bigquery_project_id
+    if _bigquery_service is None:
+        secret_file = os.path.expanduser('~/bigquery_secret.json')
+        if not os.path.exists(secret_file):
+            return (None, None)
+        with open(secret_file) as f:
+            json_key = json.load(f)
+
+        project_id = json_key.get('project_id')
+        bigqueryrc = os.path.expanduser('~/.bigqueryrc')
+        if not project_id and os.path.exists(bigqueryrc):
+            with open(bigqueryrc) as f:
+                for line in f:
+                    (key, _, value) = line.partition('=')
+                    if key.strip() == 'project_id':
+                        project_id = value.strip()
+        if not project_id:
+            return (None, None)
+
+        credentials = oauth2client.client.SignedJwtAssertionCredentials(
+            json_key['client_email'], json_key['private_key'],
+            'https://www.googleapis.com/auth/bigquery')
+        http = credentials.authorize(httplib2.Http())
+        _bigquery_service = apiclient.discovery.build(serviceName='bigquery',
+                                                      version='v2', http=http)
+        _bigquery_project_id = project_id
+    return (_bigquery_service, _bigquery_project_id)
+
+
+def _iter_query_rows(service, project_id, sql_query, max_rows,
+                     page_size=1000, timeout_ms=10000):
+    """Run a query with the BigQuery API and yield its rows as dicts.
+
+    We start the query, wait for it to finish, then fetch the results a
+    page at a time, yielding each row (typed according to the query's
+    schema; see _typed_rows()) as its page arrives.  We stop after
+    max_rows rows.
+    """
+    jobs = service.jobs()
+    response = jobs.query(projectId=project_id,
+                          body={'query': sql_query,
+                                'timeoutMs': timeout_ms,
+                                'maxResults': page_size}).execute()
+    job_id = response['jobReference']['jobId']
+    num_rows = 0
+    while True:
+        # If the query hasn't finished, this waits for up to timeout_ms
+        # for it to, and otherwise gets the next page of results.
+        if response.get('jobComplete'):
+            fields = response['schema']['fields']
+            rows = response.get('rows', [])[:max_rows - num_rows]
+            columns = [[row['f'][i]['v'] for row in rows]
+                       for i in xrange(len(fields))]
+            for typed_row in _typed_rows(fields, columns):
+                yield typed_row
+            num_rows += len(rows)
+            if num_rows >= max_rows or not response.get('pageToken'):
+                return
+        response = jobs.getQueryResults(
+            projectId=project_id, jobId=job_id, timeoutMs=timeout_ms,
+            maxResults=page_size,
+            pageToken=response.get('pageToken')).execute()
+
+
+def query_bigquery(sql_query, retries=2, max_rows=10000):
+    """Run a query, and return the results as a json list (each row is a dict).
+
+    We run the query in this process, using the BigQuery API (see
+    _get_bigquery_service()), and type each column according to the
+    query's schema.  If we don't have credentials for that, we fall back
+    to running the 'bq' tool; see _query_bigquery_with_bq_tool().
+
+    Queries fail every once in a while for flaky reasons, so by default we
+    retry the query a few times.
+
+    We return at most max_rows rows.  We probably only want to display the
+    first 100 or so, but the rest may be useful to save.
+    """
+    (service, project_id) = _get_bigquery_service()
+    if service is None:
+        return _query_bigquery_with_bq_tool(sql_query, retries, max_rows)
+
+    for i in range(1 + retries):
+        try:
+            return list(_iter_query_rows(service, project_id, sql_query,
+                                         max_rows))
+        except (apiclient.errors.HttpError, httplib2.HttpLib2Error,
+                socket.error) as why:
+            print "-- Running query failed: %s --" % why
+
+    raise Exception("-- Query failed after %d retries --" % retries)
+
+
+def _run_bq_tool(args):
+    """Run the 'bq' tool with the given arguments, and parse its output."""
+    return json.loads(subprocess.check_output(
+        ['bq', '-q', '--format=json', '--headless'] + args))
+
+
+def _bq_tool_schema(job_id):
+    """Return the 'fields' of a finished query job's schema, or None.
+
+    The bq tool's query output has no schema, so we look it up on the
+    job: newer (standard SQL) jobs have it in their statistics, and
+    otherwise we read it from the temporary table the job wrote its
+    results to.  Neither re-runs the query.  If we can't get the
+    schema, we say why and return None.
+    """
+    try:
+        job = _run_bq_tool(['show', '-j', job_id])
+        schema = job.get('statistics', {}).get('query', {}).get('schema')
+        if schema is None:
+            table = job['configuration']['query']['destinationTable']
+            schema = _run_bq_tool(
+                ['show', '%(projectId)s:%(datasetId)s.%(tableId)s' % table]
+            )['schema']
+        return schema['fields']
+    except (subprocess.CalledProcessError, KeyError, ValueError) as why:
+        print "-- Could not get the schema of job %s: %s --" % (job_id, why)
+        return None
+
+
+def _query_bigquery_with_bq_tool(sql_query, retries=2, max_rows=10000):
     """Use the 'bq' tool to run a query, and return the results as
     a json list (each row is a dict).
 
-    We do naive type conversion to int and float, when possible.
+    The bq tool's json output is all strings, so we look up the schema
+    of the query's job and type each column by it, as query_bigquery()
+    does; see _bq_tool_schema().  If we can't get the schema we leave
+    every value as a string, rather than guess which columns are
+    numbers.
 
     The bq tool fails every once in a while for flaky reasons, so by default we
     retry the query a few times.
@@ -106,38 +517,32 @@ def query_bigquery(sql_query, retries=2):
     # We could probably do 'import bq' and call out directly, but
     # I couldn't figure out an easy way to do this.  Ah well.
     # To avoid having to deal with paging (which I think the command-line bq is
-    # not very good at anyway), we just get a bunch of rows.  We probably only
-    # want to display the first 100 or so, but the rest may be useful to save.
+    # not very good at anyway), we just get a bunch of rows.
 
-    data = None
+    rows = None
 
     for i in range(1 + retries):
+        # We name the job, so we can look up its schema afterwards.
+        job_id = 'bq_util_%s' % uuid.uuid4().hex
         try:
-            data = subprocess.check_output(
-                            ['bq', '-q', '--format=json', '--headless',
-                             'query', '--max_rows=10000', sql_query])
+            rows = _run_bq_tool(['--job_id=%s' % job_id, 'query',
+                                 '--max_rows=%d' % max_rows, sql_query])
 
             break
         except subprocess.CalledProcessError as why:
             print "-- Running query failed with retcode %d --" % why.returncode
             print why.output
 
-    if data is None:
+    if rows is None:
         raise Exception("-- Query failed after %d retries --" % retries)
+    if not rows:
+        return rows
 
-    table = json.loads(data)
-
-    for row in table:
-        for key in row:
-            if row[key] is None:
-                row[key] = '(None)'
-            else:
-                try:
-                    row[key] = int(row[key])
-                except ValueError:
-                    try:
-                        row[key] = float(row[key])
-                    except ValueError:
-                        pass
-
-    return table
+    fields = _bq_tool_schema(job_id)
+    # Nested fields are flattened in the output, so their names won't
+    # match the schema's; we don't try to type those.
+    if fields is None or (sorted(field['name'] for field in fields)
+                          != sorted(rows[0])):
+        fields = [{'name': name, 'type': 'STRING'} for name in rows[0]]
+    columns = [[row.get(field['name']) for row in rows] for field in fields]
+    return _typed_rows(fields, columns, _BQ_TOOL_TYPE_CONVERTERS)
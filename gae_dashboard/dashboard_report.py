@@ -22,16 +22,20 @@ Records are sent to graphite under the keys
 import argparse
 import collections
 import datetime
+import itertools
 import json
+import multiprocessing
 import os
 import sys
 
 import GChartWrapper
 
 import graphite_util
+import state_util
 
 
-_LAST_RECORD_DB = os.path.join(os.getenv('HOME'), 'dashboard_report_time.db')
+_LAST_RECORD_DB = state_util.State(
+    os.path.join(os.getenv('HOME'), 'dashboard_report_time.db'))
 
 
 # This mapping is used to turn chart labels and possibly data labels
@@ -93,6 +97,24 @@ _label_to_field_map = collections.OrderedDict(
      ])
 
 
+def _compile_chart_field_table(label_to_field_map):
+    """Turn _label_to_field_map into a list indexed by chart_num.
+
+    Each entry is a pair (chart_label, {series_label: field_name}).
+    Charts whose label maps to a lone field name have no series labels
+    (no "chdl" query parameter), so we key that field name by None.
+    """
+    table = []
+    for (chart_label, field_names) in label_to_field_map.iteritems():
+        if isinstance(field_names, basestring):
+            field_names = {None: field_names}
+        table.append((chart_label, dict(field_names)))
+    return table
+
+
+_chart_field_table = _compile_chart_field_table(_label_to_field_map)
+
+
 # Map from the text on the time-window picker on the GAE dashboards
 # homepage, to how long that is, in hours.  The ordering *must* match
 # the ordering of the selectors on the GAE dashboard homepage.
@@ -112,30 +134,41 @@ _time_windows = [
 
 # NOTE: Used by fetch_stats.py
 def num_charts():
-    return len(_label_to_field_map)
+    return len(_chart_field_table)
 
 
-def _time_t_of_latest_record():
-    """time_t of the most recently stored dashboard record.
+def _read_high_water_marks():
+    """Per-(module, chart) time_t of the most recently stored data.
 
-    This data is stored in a file.  We could consider this a small database.
+    This data is stored in a file.  We could consider this a small
+    database.  It holds a JSON map of module -> chart label -> time_t.
+    Callers should hold _LAST_RECORD_DB.locked() while using it.
+    Older versions of this script stored a single time_t for all
+    modules and charts; if we find such a file we use that time_t for
+    every (module, chart) pair.
 
     Returns:
-        The time_t (# of seconds since the UNIX epoch in UTC) or None if
-        there is no previous record.
+        A pair (marks, default_time_t).  marks is a dict mapping
+        module -> {chart_label: time_t}, and default_time_t is the
+        time_t to use for a (module, chart) pair that is not in marks,
+        or None if all such data should be imported as new.
     """
-    if os.path.exists(_LAST_RECORD_DB):
-        with open(_LAST_RECORD_DB) as f:
-            return int(f.read().strip())
-    return None
+    contents = _LAST_RECORD_DB.read()
+    if contents is None:
+        return ({}, None)
+    if isinstance(contents, (int, long)):
+        return ({}, contents)
+    return (contents, None)
 
 
-def _write_time_t_of_latest_record(records):
-    """Find the record with the latest time-t and write it to the db."""
-    epoch = datetime.datetime.utcfromtimestamp(0)
-    latest_record = max(records, key=lambda r: r['utc_datetime'])
-    with open(_LAST_RECORD_DB, 'w') as f:
-        print >>f, int((latest_record['utc_datetime'] - epoch).total_seconds())
+def _write_high_water_marks(marks):
+    """Write the per-(module, chart) time_t's to the db.
+
+    Marks only ever move forward: if marks has an older time_t for a
+    chart than the db does, we keep the db's.
+    """
+    (old_marks, _) = _read_high_water_marks()
+    _LAST_RECORD_DB.write(state_util.raise_high_water_marks(old_marks, marks))
 
 
 def round_to_n_significant_digits(x, n):
@@ -149,14 +182,24 @@ def round_to_n_significant_digits(x, n):
     return float('%.*e' % (n - 1, x))
 
 
-def lookup_field_name(chart_label, series_label=None):
-    """Map a series in a well-known chart to the analytics database
-    field name used to store its data points."""
-    field_name = _label_to_field_map[chart_label]
-    if isinstance(field_name, basestring):
-        return field_name
-    else:
-        return field_name[series_label]
+def check_series_labels(chart_num, series_labels, module=None):
+    """Raise ValueError if a chart has series we don't know how to store.
+
+    Arguments:
+      chart_num: an index into _chart_field_table.
+      series_labels: the chart's data labels, as returned by
+        unpack_chart_data(); None for a chart without a "chdl" param.
+      module: (Optional) the module the chart is for, for the message.
+    """
+    (chart_label, field_names) = _chart_field_table[chart_num]
+    unknown_labels = [l for l in series_labels if l not in field_names]
+    if unknown_labels:
+        raise ValueError('Chart #%s (%r%s) has unknown series labels %s; '
+                         'expected labels are %s.  Has the GAE dashboard '
+                         'changed?  If so, update _label_to_field_map.'
+                         % (chart_num, chart_label,
+                            ', module %s' % module if module else '',
+                            unknown_labels, sorted(field_names)))
 
 
 def get_axis_labels(chart):
@@ -286,91 +329,256 @@ def aggregate_series_by_time(named_series):
         yield x_value, record
 
 
-def parse_and_commit_record(input_json, start_time_t, download_time_t,
-                            graphite_host, verbose=False, dry_run=False):
-    """Parse and store dashboard chart data.
+def decode_module_charts(module, chart_jsons, module_marks, default_time_t,
+                         download_time_t):
+    """Decode all the charts for one module into time-keyed records.
 
     Arguments:
-      input_json: A JSON list of dicts containing the chart-url for
-         one chart, along with an int describing which chart it is
-         and other identifying data; see the help for <infile> in main(),
-         or just look at how this json is constructed in fetch_stats.sh.
-      start_time_t: Ignore all datapoints before this time_t (given that
-         the last datapoint is at time download_time_t).  May be None,
-         in which case we don't ignore any datapoints.
+      module: the GAE module the charts are for.
+      chart_jsons: the elements of input_json (see
+         parse_and_commit_record()) that are for this module.
+      module_marks: a dict mapping chart_label -> time_t.  For each
+         chart, ignore all datapoints at or before that time_t.
+      default_time_t: The time_t to use for charts that have no entry
+         in module_marks, or None to not ignore any datapoints for them.
+      download_time_t: When /dashboard was downloaded in seconds (UTC).
+
+    Returns:
+      A triple (records, new_module_marks, bad_chart_errors).  records
+      is a list of dicts as expected by
+      graphite_util.maybe_send_to_graphite().  new_module_marks is a
+      copy of module_marks updated with the time_t of the latest
+      datapoint seen in each chart.  bad_chart_errors lists a message
+      for each chart we skipped because it has series labels we don't
+      know how to store (see check_series_labels()); the module's
+      other charts are still decoded.
+    """
+    # Assume all of the module's charts have the same time window.
+    assert all(chart_json['time_window'] == chart_jsons[0]['time_window']
+               for chart_json in chart_jsons)
+    time_label_index = chart_jsons[0]['time_window']
+    (time_label, time_duration) = _time_windows[time_label_index]
+    time_delta_seconds = datetime.timedelta(hours=time_duration).total_seconds()
+    chart_start_time_t = download_time_t - time_delta_seconds
+
+    new_module_marks = dict(module_marks)
+    bad_chart_errors = []
+
+    # Extract named time series data from the raw HTML, keeping only
+    # the datapoints that are newer than the chart's high-water mark.
+    named_series = {}
+    for chart_json in chart_jsons:
+        chart_label_index = chart_json['chart_num']
+        (chart_label, field_names) = _chart_field_table[chart_label_index]
+        start_time_t = module_marks.get(chart_label, default_time_t)
+
+        chart_url = chart_json['chart_url_data']['chart_url']
+        chart_data = list(unpack_chart_data(chart_url, time_delta_seconds))
+        try:
+            check_series_labels(
+                chart_label_index,
+                [series_label for (series_label, _) in chart_data], module)
+        except ValueError, why:
+            bad_chart_errors.append(str(why))
+            continue
+        for series_label, xy_pairs in chart_data:
+            field_name = field_names[series_label]
+            if start_time_t:
+                xy_pairs = [(x, y) for (x, y) in xy_pairs
+                            if chart_start_time_t + x > start_time_t]
+            named_series[field_name] = xy_pairs
+
+            # The chart's new high-water mark is its latest datapoint
+            # across all series, or its old mark if nothing is new.
+            time_ts = [int(chart_start_time_t + x) for (x, y) in xy_pairs]
+            if start_time_t:
+                time_ts.append(start_time_t)
+            if time_ts:
+                new_module_marks[chart_label] = max(
+                    time_ts + [new_module_marks.get(chart_label, 0)])
+
+    # Build time-keyed records from the named time series data.
+    records = []
+    for time_value, record in aggregate_series_by_time(named_series):
+        record_time_t = chart_start_time_t + time_value
+        record['utc_datetime'] = datetime.datetime.utcfromtimestamp(
+            record_time_t)
+        records.append(record)
+
+    return (records, new_module_marks, bad_chart_errors)
+
+
+def _decode_module_charts_worker(args):
+    """Call decode_module_charts(*args) and tag its result with the module.
+
+    multiprocessing.Pool.imap_unordered() only passes a single
+    argument to a (top-level, so picklable) function, hence this.
+    """
+    return (args[0],) + decode_module_charts(*args)
+
+
+def parse_and_commit_records_by_module(chart_jsons_by_module,
+                                      high_water_marks, default_time_t,
+                                      download_time_t, graphite_host,
+                                      verbose=False, dry_run=False,
+                                      processes=1, pool=None,
+                                      sent_marks=None):
+    """Parse and store dashboard chart data, one module at a time.
+
+    Arguments:
+      chart_jsons_by_module: An iterable of (module, chart_jsons) pairs,
+         where chart_jsons is a list of all the elements of input_json
+         (see parse_and_commit_record()) for that module.  This may be
+         a generator that yields each module as soon as its charts have
+         been downloaded: each module is decoded and sent to graphite
+         while later modules are still being fetched.
+      high_water_marks: A dict mapping module -> {chart_label: time_t}.
+         For each chart, ignore all datapoints at or before that time_t
+         (given that the last datapoint is at time download_time_t).
+      default_time_t: The time_t to use for charts that have no entry
+         in high_water_marks.  May be None, in which case we don't
+         ignore any datapoints for such charts.
       download_time_t: When /dashboard was downloaded in seconds (UTC).
       graphite_host: host:port of graphite server to send data to.
       verbose: If True, print report to stdout.
       dry_run: If True, do not store report in the database.
+      processes: If more than 1, decode the charts for each module in
+         a pool of this many worker processes.  Chart decoding is
+         CPU-bound, so this lets us use all the cores on the machine.
+      pool: (Optional) a multiprocessing.Pool to decode the charts in,
+         instead of creating one; processes is then ignored.  Callers
+         that start threads should create the pool first, since forking
+         while other threads are running can leave the workers holding
+         those threads' locks.
+      sent_marks: (Optional) a dict we add module -> {chart_label:
+         time_t} to as soon as each module's records have been sent to
+         graphite.  If we raise partway through, the caller can still
+         save the marks for the modules that were sent.
+
+    Returns:
+      A copy of high_water_marks updated with the time_t of the latest
+      datapoint imported for each chart, or None if nothing was
+      imported.
+
+    Raises:
+      ValueError if any chart had series labels we don't know how to
+      store.  We skip just those charts, and only raise once all the
+      other charts have been sent to graphite.
     """
-    if not input_json:
-        return
+    decode_args = ((module, chart_jsons, high_water_marks.get(module, {}),
+                    default_time_t, download_time_t)
+                   for (module, chart_jsons) in chart_jsons_by_module)
+
+    new_high_water_marks = dict((module, dict(marks))
+                                for (module, marks)
+                                in high_water_marks.iteritems())
+    num_records = 0
+    all_bad_chart_errors = []
+    own_pool = pool is None and processes > 1
+    if own_pool:
+        pool = multiprocessing.Pool(processes)
+    try:
+        if pool:
+            results = pool.imap_unordered(_decode_module_charts_worker,
+                                          decode_args)
+        else:
+            results = itertools.imap(_decode_module_charts_worker,
+                                     decode_args)
+        for (module, records, module_marks, bad_chart_errors) in results:
+            for error in bad_chart_errors:
+                print >>sys.stderr, 'Skipping chart: %s' % error
+            all_bad_chart_errors.extend(bad_chart_errors)
+            if verbose:
+                print {module: records}
+            print 'Importing %d record%s for module %s' % (
+                len(records), 's'[len(records) == 1:], module)
+            if dry_run or not records:
+                continue
+            graphite_util.maybe_send_to_graphite(graphite_host, 'summary',
+                                                 records, module=module)
+            new_high_water_marks[module] = module_marks
+            if sent_marks is not None:
+                sent_marks[module] = module_marks
+            num_records += len(records)
+    finally:
+        if own_pool:
+            pool.terminate()
+
+    if all_bad_chart_errors:
+        raise ValueError('Skipped %d chart%s with unknown series labels:\n%s'
+                         % (len(all_bad_chart_errors),
+                            's'[len(all_bad_chart_errors) == 1:],
+                            '\n'.join(all_bad_chart_errors)))
 
-    # Extract named time series data from the raw HTML.
-    named_series_by_module = {}
+    if dry_run:
+        print 'Skipping import during dry-run.'
+        return None
+    if not num_records:
+        return None
+    return new_high_water_marks
+
+
+def _group_by_module(input_json):
+    """Return (module, chart_jsons) pairs for input_json, in input order."""
+    chart_jsons_by_module = collections.OrderedDict()
     for chart_json in input_json:
-        chart_label_index = chart_json['chart_num']
-        chart_label = _label_to_field_map.keys()[chart_label_index]
+        chart_jsons_by_module.setdefault(chart_json['module'], []).append(
+            chart_json)
+    return chart_jsons_by_module.items()
 
-        module = chart_json['module']
 
-        time_label_index = chart_json['time_window']
-        (time_label, time_duration) = _time_windows[time_label_index]
-        time_delta = datetime.timedelta(hours=time_duration)
+def parse_and_commit_record(input_json, high_water_marks, default_time_t,
+                            download_time_t, graphite_host,
+                            verbose=False, dry_run=False, processes=1):
+    """Parse and store dashboard chart data.
 
-        chart_url = chart_json['chart_url_data']['chart_url']
-        chart_data = unpack_chart_data(chart_url, time_delta.total_seconds())
-        for series_label, xy_pairs in chart_data:
-            field_name = lookup_field_name(chart_label, series_label)
-            named_series_by_module.setdefault(module, {})
-            named_series_by_module[module][field_name] = xy_pairs
-
-    # Assume all elements of our input_json list have the same time window.
-    assert all(input_json[i]['time_window'] == input_json[0]['time_window']
-               for i in xrange(len(input_json)))
-    chart_start_time_t = download_time_t - time_delta.total_seconds()
-
-    # Build time-keyed records from the named time series data and
-    # decide which records will be stored.
-    records_by_module = {}
-    for (module, named_series) in named_series_by_module.iteritems():
-        records_by_module[module] = []
-        for time_value, record in aggregate_series_by_time(named_series):
-            record_time_t = chart_start_time_t + time_value
-            if not start_time_t or record_time_t > start_time_t:
-                record['utc_datetime'] = datetime.datetime.utcfromtimestamp(
-                    record_time_t)
-                records_by_module[module].append(record)
-
-    if verbose:
-        print records_by_module
-
-    records = reduce(lambda x, y: x + y, records_by_module.values(), [])
-    print 'Importing %d record%s' % (len(records), 's'[len(records) == 1:])
-    if dry_run:
-        print 'Skipping import during dry-run.'
-        records = []
-    elif records_by_module:
-        for (module, records) in records_by_module.iteritems():
-            graphite_util.maybe_send_to_graphite(graphite_host, 'summary',
-                                                 records, module=module)
+    Arguments:
+      input_json: A JSON list of dicts containing the chart-url for
+         one chart, along with an int describing which chart it is
+         and other identifying data; see the help for <infile> in main(),
+         or just look at how this json is constructed in fetch_stats.sh.
+      The other arguments and the return value are as for
+         parse_and_commit_records_by_module().
+    """
+    return parse_and_commit_records_by_module(
+        _group_by_module(input_json), high_water_marks, default_time_t,
+        download_time_t, graphite_host, verbose, dry_run, processes)
 
-    return records
 
+def main_by_module(chart_jsons_by_module, utc_timestamp, graphite_host,
+                   verbose=False, dry_run=False, processes=1, pool=None):
+    """Like main(), but takes input grouped by module.
 
-def main(input_json, utc_timestamp, graphite_host,
-         verbose=False, dry_run=False):
-    """input_json: list of {chart_num, module, time_window, chart_url_data}."""
-    time_t_of_latest_record = _time_t_of_latest_record()
-    if time_t_of_latest_record is None:
-        print 'No record of previous fetches; importing all records as new.'
+    chart_jsons_by_module: an iterable of (module, chart_jsons) pairs;
+    see parse_and_commit_records_by_module(), as for pool.
+    """
+    # We hold the lock for the whole import, so if another run starts
+    # meanwhile it waits, then only imports what we didn't.
+    with _LAST_RECORD_DB.locked():
+        (high_water_marks, default_time_t) = _read_high_water_marks()
+        if not high_water_marks and default_time_t is None:
+            print ('No record of previous fetches; '
+                   'importing all records as new.')
+
+        # Each module is sent to graphite as soon as it's decoded, so
+        # if a later module fails we still save the marks for the
+        # earlier ones; otherwise the next run would send them again.
+        sent_marks = {}
+        try:
+            parse_and_commit_records_by_module(
+                chart_jsons_by_module, high_water_marks, default_time_t,
+                utc_timestamp, graphite_host, verbose, dry_run, processes,
+                pool, sent_marks)
+        finally:
+            if sent_marks:
+                _write_high_water_marks(sent_marks)
 
-    records = parse_and_commit_record(
-        input_json, time_t_of_latest_record, utc_timestamp, graphite_host,
-        verbose, dry_run)
 
-    if records:
-        _write_time_t_of_latest_record(records)
+def main(input_json, utc_timestamp, graphite_host,
+         verbose=False, dry_run=False, processes=1):
+    """input_json: list of {chart_num, module, time_window, chart_url_data}."""
+    main_by_module(_group_by_module(input_json), utc_timestamp, graphite_host,
+                   verbose, dry_run, processes)
 
 
 if __name__ == '__main__':
@@ -393,6 +601,9 @@ if __name__ == '__main__':
                         help='print report on stdout')
     parser.add_argument('-n', '--dry-run', action='store_true', default=False,
                         help='do not store report in the database')
+    parser.add_argument('-j', '--processes', type=int, default=1,
+                        help=('decode the charts for each module in a pool '
+                              'of this many processes [default: %(default)s]'))
     args = parser.parse_args()
 
     # This json.load() will raise an exception error if the input is
@@ -405,4 +616,4 @@ if __name__ == '__main__':
         raise
 
     main(input_json, args.utc_timestamp, args.graphite_host,
-         args.verbose, args.dry_run)
+         args.verbose, args.dry_run, args.processes)
@@ -284,7 +284,8 @@ ORDER BY instance_hours DESC
     data = bq_util.query_bigquery(query)
     bq_util.save_daily_data(data, "instance_hours", yyyymmdd)
     historical_data = bq_util.process_past_data(
-        "instance_hours", date, 14, lambda row: row['url_route'])
+        "instance_hours", date, 14, lambda row: row['url_route'],
+        columns=['url_route', 'instance_hours', 'count_'])
 
     # Munge the table by adding a few columns.
     total_instance_hours = 0.0
@@ -355,7 +356,8 @@ ORDER BY tcost.rpc_cost DESC;
     data = bq_util.query_bigquery(query)
     bq_util.save_daily_data(data, "rpcs", yyyymmdd)
     historical_data = bq_util.process_past_data(
-        "rpcs", date, 14, lambda row: row['url_route'])
+        "rpcs", date, 14, lambda row: row['url_route'],
+        columns=['url_route', 'rpc_cost', 'requests'])
 
     # Munge the table by getting per-request counts for every RPC stat.
     micropennies = '&mu;&cent;'
@@ -418,7 +420,7 @@ ORDER BY count_ DESC
     bq_util.save_daily_data(data, "out_of_memory_errors_by_module", yyyymmdd)
     historical_data = bq_util.process_past_data(
         "out_of_memory_errors_by_module", date, 14,
-        lambda row: row['module_id'])
+        lambda row: row['module_id'], columns=['module_id', 'count_'])
 
     for row in data:
         sparkline_data = []
@@ -456,7 +458,8 @@ ORDER BY count_ DESC
     bq_util.save_daily_data(data, "out_of_memory_errors_by_route", yyyymmdd)
     historical_data = bq_util.process_past_data(
         "out_of_memory_errors_by_route", date, 14,
-        lambda row: (row['module_id'], row['url_route']))
+        lambda row: (row['module_id'], row['url_route']),
+        columns=['module_id', 'url_route', 'count_'])
 
     for row in data:
         sparkline_data = []
@@ -581,7 +584,8 @@ ORDER BY added_total DESC
     bq_util.save_daily_data(data, "memory_increases", yyyymmdd)
     historical_data = bq_util.process_past_data(
         "memory_increases", date, 14,
-        lambda row: (row['module'], row['url_route']))
+        lambda row: (row['module'], row['url_route']),
+        columns=['module', 'url_route', 'added_avg'])
 
     by_module = collections.defaultdict(list)
     for row in data:
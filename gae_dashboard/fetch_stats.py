@@ -5,13 +5,17 @@
 This is a wrapper around ka_report.py, which stores data for every
 page except for the dashboard homepage (eg /instance_summary), and
 dashboard_report.py, which stores data for one chart on the main
-homepage, for a single module.
+homepage, for a single module.  Each module's charts are sent to
+dashboard_report.py as soon as they have all been downloaded, while
+the charts for other modules are still being fetched.
 """
 
 import calendar
 import datetime
 import json
+import multiprocessing
 import os
+import Queue
 import threading
 
 import dashboard_report
@@ -25,21 +29,73 @@ import ka_report
 _WINDOW = 0
 
 
-def _fetch_one_chart(email, password, application, module, chartnum,
-                     chartmap, chartmap_lock, verbose):
-    # TODO(csilvers): can all the threads share a single DashboardClient?
-    dashclient = gae_dashboard_curl.DashboardClient(email, password)
-    url = ('/dashboard/stats?app_id=%s&version_id=%s:&type=%s&window=%s'
-           % (application, module, chartnum, _WINDOW))
-    data = dashclient.fetch(url)
-    with chartmap_lock:
-        chartmap[(module, chartnum)] = json.loads(data)
-    if verbose:
-        print '>>> Got data from chart #%s in module %s' % (chartnum, module)
+def _fetch_one_chart(dashclient, application, module, chartnum,
+                     results_queue, verbose):
+    """Fetch one chart and put (module, chartnum, json) on results_queue.
+
+    The json is None if the fetch failed.  We always put something on
+    the queue so the consumer knows when it has heard from every fetch.
+    """
+    chart_data = None
+    try:
+        url = ('/dashboard/stats?app_id=%s&version_id=%s:&type=%s&window=%s'
+               % (application, module, chartnum, _WINDOW))
+        chart_data = json.loads(dashclient.fetch(url))
+        if verbose:
+            print ('>>> Got data from chart #%s in module %s'
+                   % (chartnum, module))
+    finally:
+        results_queue.put((module, chartnum, chart_data))
+
+
+def _charts_by_module(results_queue, modules, num_charts, bad_fetches):
+    """Yield (module, chart_jsons) as soon as each module's charts are in.
+
+    This reads from the results_queue that _fetch_one_chart() writes
+    to, and yields input for dashboard_report.main_by_module().  If
+    any chart for a module could not be fetched, we add (module,
+    chartnum) to bad_fetches and never yield that module.
+    """
+    chartmap = dict((module, {}) for module in modules)
+    for _ in xrange(len(modules) * num_charts):
+        (module, chartnum, chart_data) = results_queue.get()
+        chartmap[module][chartnum] = chart_data
+        if chart_data is None:
+            bad_fetches.append((module, chartnum))
+        if len(chartmap[module]) < num_charts:
+            continue
+
+        charts = chartmap.pop(module)
+        if any(charts[chartnum] is None for chartnum in charts):
+            continue
+        yield (module, [{'chart_num': chartnum,
+                         'module': module,
+                         'time_window': _WINDOW,
+                         'chart_url_data': charts[chartnum],
+                         } for chartnum in xrange(num_charts)])
 
 
 def main(email, password, application, graphite_host,
-         verbose=False, dry_run=False):
+         verbose=False, dry_run=False, processes=1):
+    # We fork the decoding processes now, before we start any threads
+    # (ka_report, get_modules() and the chart fetches all do), since a
+    # process forked while threads are running can inherit their locks
+    # in a held state and deadlock.
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    # All the chart fetches share a RetryPolicy, so we can report how
+    # much retrying they needed in total.
+    retry_policy = gae_dashboard_curl.RetryPolicy()
+    try:
+        _fetch_and_report(email, password, application, graphite_host,
+                          verbose, dry_run, pool, retry_policy)
+    finally:
+        if pool:
+            pool.terminate()
+        retry_policy.log_summary('fetch_stats charts')
+
+
+def _fetch_and_report(email, password, application, graphite_host,
+                      verbose, dry_run, pool, retry_policy):
     # First, run ka_report.py.
     # TODO(csilvers): do this in a thread (or separate process?) so
     # it's data-fetching can intersperse with dashboard_report.
@@ -57,50 +113,42 @@ def main(email, password, application, graphite_host,
     now = calendar.timegm(now_dt.timetuple())
 
     num_charts = dashboard_report.num_charts()
-    modules = gae_util.get_modules(email, password, application)
-
-    # Now use curl to collect the stats for each chart.
-    chartmap_lock = threading.Lock()
-    chartmap = {}
-    threads = []
-    for module in modules:
-        for chartnum in xrange(num_charts):
-            chartmap[(module, chartnum)] = None    # initialize
+    # Modules with no versions deployed don't have any stats.
+    modules = [module for (module, versions)
+               in gae_util.get_modules(email, password, application).items()
+               if versions]
+
+    # Now use curl to collect the stats for each chart.  Fetches for
+    # all modules run in parallel, and we hand each module off to
+    # dashboard_report as soon as all its charts have arrived.  The
+    # threads share one client, so we log in at most once.
+    dashclient = gae_dashboard_curl.DashboardClient(
+        email, password,
+        response_cache_dir=gae_dashboard_curl.RESPONSE_CACHE_DIR,
+        retry_policy=retry_policy)
+    results_queue = Queue.Queue()
     for module in modules:
         for chartnum in xrange(num_charts):
             thread = threading.Thread(target=_fetch_one_chart,
-                                      args=(email, password, application,
+                                      args=(dashclient, application,
                                             module, chartnum,
-                                            chartmap, chartmap_lock, verbose))
-            threads.append(thread)
+                                            results_queue, verbose))
             thread.start()
-    # Wait for all the urls to be fetched
     if verbose:
         print ('>>> Waiting for data from %s charts in %s modules'
                % (num_charts, len(modules)))
-    for thread in threads:
-        thread.join()
+
+    bad_fetches = []
+    dashboard_report.main_by_module(
+        _charts_by_module(results_queue, modules, num_charts, bad_fetches),
+        now, graphite_host, verbose, dry_run, pool=pool)
 
     # Exceptions in threads are swallowed :-(, so we have to manually
-    # check that they all succeeded.
-    bad_fetches = [k for k in chartmap if chartmap[k] is None]
+    # check that they all succeeded.  The modules whose charts were all
+    # fetched have been reported by now, even if this raises.
     if bad_fetches:
         raise ValueError("Failed to fetch the following module/chart-nums: %s"
-                         % bad_fetches)
-
-    dashboard_report_input = []
-    for module in modules:
-        for chartnum in xrange(num_charts):
-            dashboard_report_input.append({
-                'chart_num': chartnum,
-                'module': module,
-                'time_window': _WINDOW,
-                'chart_url_data': chartmap[(module, chartnum)],
-            })
-
-    # Now we can finally call the dashboard report!
-    dashboard_report.main(dashboard_report_input, now, graphite_host,
-                          verbose, dry_run)
+                         % sorted(bad_fetches))
 
 
 if __name__ == '__main__':
@@ -125,10 +173,13 @@ if __name__ == '__main__':
                         help="Show more information about what we're doing.")
     parser.add_argument('--dry-run', '-n', action='store_true',
                         help="Show what we would do but don't do it.")
+    parser.add_argument('--processes', '-j', type=int, default=1,
+                        help=('Decode the charts for each module in a pool '
+                              'of this many processes. (Default: %(default)s)'))
     args = parser.parse_args()
 
     with open(args.private_pw) as f:
         password = f.read().strip()
 
     main(args.email, password, args.application, args.graphite_host,
-         args.verbose, args.dry_run)
+         args.verbose, args.dry_run, args.processes)
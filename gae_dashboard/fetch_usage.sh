@@ -3,14 +3,15 @@
 # This script is meant to be run as a cron job each morning (PST) to download
 # daily usage reports from the GAE dashboard and send them to graphite.
 #
-# All arguments are passed through to load_usage_reports.py.
+# All arguments are passed through to load_usage_reports.py, which
+# downloads the reports itself.
 
 set -e
 
 : ${srcdir:="${HOME}/internal-webserver/gae_dashboard"}
 : ${private_pw:="${HOME}/private_pw"}
 : ${username:="khanbackups@gmail.com"}
-: ${url:="https://appengine.google.com/billing/history.csv?app_id=s~khan-academy"}
+: ${app_id:="s~khan-academy"}
 
 # Add appengine SDK to the path.
 export PATH="/usr/local/google_appengine:$PATH"
@@ -20,6 +21,5 @@ if [ ! -e "${private_pw}" ]; then
     exit 1
 fi
 
-"${srcdir}/gae_dashboard_curl.py" "${url}" "${username}" \
-    < "${private_pw}" \
-    | "${srcdir}/load_usage_reports.py" "$@"
+"${srcdir}/load_usage_reports.py" --email="${username}" -A "${app_id}" "$@" \
+    < "${private_pw}"
@@ -17,47 +17,306 @@ To use this module as a library:
   dashclient = gae_dashboard_curl.DashboardClient(email, password)
   instances_html = dashclient.fetch('/instances?app_id=s~test-app')
 
+or, to read a large page a line at a time as it's downloaded:
+
+  for line in dashclient.open('/billing/history.csv?app_id=s~test-app'):
+      ...
+
+If $GAE_DASHBOARD_COOKIE_DIR is set, login cookies are saved there,
+per email address, and later runs reuse them instead of logging in
+again until the login expires.
+
+Responses are requested gzip-compressed, and decompressed as they're
+read.  If DashboardClient is given a response_cache_dir (the scrapers
+use RESPONSE_CACHE_DIR), responses with an ETag or Last-Modified header
+are saved there and revalidated on the next fetch, so an unchanged
+page costs a 304 rather than a full download.
+
 """
 
+import cookielib
+import copy
+import errno
+import hashlib
+import httplib
+import json
+import logging
 import os
+import random
+import socket
 import sys
+import threading
 import time
+import urllib2
+import zlib
 
 # Set up GAE import paths via gae_util.py in src/
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 import gae_util
-gae_util.fix_sys_path()
+import state_util
 
-from google.appengine.tools import appengine_rpc
+# NOTE: we don't import google.appengine.tools.appengine_rpc here.
+# Finding the SDK and importing it is slow, and not needed for --help
+# or dry runs, so we wait until create_rpcserver() needs it.
 
 APPENGINE_HOST = 'appengine.google.com'
 AUTH_SOURCE = 'gae_dashboard_curl-1.0'
 USER_AGENT = 'gae_dashboard_curl.py/1.0'
 
+# Opt-in directory where we save login cookies; see create_rpcserver().
+COOKIE_CACHE_DIR = os.environ.get('GAE_DASHBOARD_COOKIE_DIR')
+
+# Where the scrapers save responses to revalidate; see fetch_contents().
+RESPONSE_CACHE_DIR = os.environ.get(
+    'GAE_DASHBOARD_RESPONSE_CACHE_DIR',
+    os.path.join(os.getenv('HOME'), 'gae_dashboard_responses'))
+
 
 class UnsupportedUrlError(Exception):
     """Raised when given an URL that is not an App Engine dashboard."""
     pass
 
 
+class CircuitOpenError(Exception):
+    """Raised instead of fetching while a host looks to be down."""
+    pass
+
+
+class CircuitBreaker(object):
+    """Stop sending requests to a host after repeated failures.
+
+    After `failure_threshold` consecutive failed fetches the circuit
+    "opens" and allow() returns False for `cooldown_seconds`.  After
+    that, fetches are allowed again; one more failure re-opens the
+    circuit immediately, while a success closes it.
+
+    This is shared by all the threads fetching from a host, so that
+    during an outage we don't have every thread pounding on it.
+    """
+    def __init__(self, failure_threshold=5, cooldown_seconds=60):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._open_until = None
+
+    def allow(self):
+        with self._lock:
+            return self._open_until is None or time.time() >= self._open_until
+
+    def record_success(self):
+        with self._lock:
+            self._consecutive_failures = 0
+            self._open_until = None
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            if self._consecutive_failures >= self.failure_threshold:
+                self._open_until = time.time() + self.cooldown_seconds
+
+
+# Map from host to the CircuitBreaker for all fetches from that host.
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(host):
+    with _circuit_breakers_lock:
+        return _circuit_breakers.setdefault(host, CircuitBreaker())
+
+
+class RetryPolicy(object):
+    """Decide whether and when DashboardClient.fetch() retries an error.
+
+    Errors are classified by classify(), and only some kinds are
+    retried.  Retries wait a random ("jittered") amount of time, up to
+    an exponentially increasing limit, so the many threads used by
+    fetch_stats.py don't all retry in lockstep.  We never wait past
+    `deadline_seconds` after the first try.
+
+    The policy also keeps count of how many retries it has done and
+    how long it has spent waiting between them, summed over all
+    fetches that use it; scripts call log_summary() at the end of a
+    run to report them.
+    """
+    # The kinds of errors classify() returns.
+    AUTH = 'auth'                          # 401 or 403: bad credentials
+    CLIENT_ERROR = 'client_error'          # other 4xx
+    SERVER_ERROR = 'server_error'          # 5xx
+    TIMEOUT = 'timeout'
+    CONNECTION_RESET = 'connection_reset'
+    OTHER = 'other'
+
+    # Retrying won't help if the request itself is bad.
+    _RETRYABLE = frozenset([SERVER_ERROR, TIMEOUT, CONNECTION_RESET, OTHER])
+
+    def __init__(self, max_tries=3, base_delay_seconds=1.0,
+                 max_delay_seconds=30.0, deadline_seconds=120.0):
+        self.max_tries = max_tries
+        self.base_delay_seconds = base_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.deadline_seconds = deadline_seconds
+        self._lock = threading.Lock()
+        self.num_retries = 0
+        self.seconds_waited = 0.0
+
+    @classmethod
+    def classify(cls, exception):
+        """Return the kind of error (one of the constants above)."""
+        if isinstance(exception, urllib2.HTTPError):
+            if exception.code in (401, 403):
+                return cls.AUTH
+            elif 400 <= exception.code < 500:
+                return cls.CLIENT_ERROR
+            elif 500 <= exception.code < 600:
+                return cls.SERVER_ERROR
+            return cls.OTHER
+        if isinstance(exception, urllib2.URLError):
+            # urllib2 wraps socket errors in a URLError.
+            if isinstance(exception.reason, Exception):
+                return cls.classify(exception.reason)
+            return cls.OTHER
+        if isinstance(exception, socket.timeout):
+            return cls.TIMEOUT
+        if isinstance(exception, socket.error):
+            if exception.errno == errno.ETIMEDOUT:
+                return cls.TIMEOUT
+            if exception.errno in (errno.ECONNRESET, errno.ECONNREFUSED,
+                                   errno.EPIPE):
+                return cls.CONNECTION_RESET
+            return cls.OTHER
+        if isinstance(exception, (httplib.BadStatusLine,
+                                  httplib.IncompleteRead)):
+            return cls.CONNECTION_RESET
+        return cls.OTHER
+
+    def retry_delay(self, num_tries, start_time):
+        """Seconds to wait before trying again, or None to give up.
+
+        Arguments:
+          num_tries: how many times we have tried the fetch so far.
+          start_time: the time.time() of the first try.
+        """
+        if num_tries >= self.max_tries:
+            return None
+        limit = min(self.max_delay_seconds,
+                    self.base_delay_seconds * 2 ** (num_tries - 1))
+        delay = random.uniform(0, limit)
+        if time.time() + delay - start_time > self.deadline_seconds:
+            return None
+        return delay
+
+    def should_retry(self, exception):
+        return self.classify(exception) in self._RETRYABLE
+
+    def record_retry(self, seconds_waited):
+        with self._lock:
+            self.num_retries += 1
+            self.seconds_waited += seconds_waited
+
+    def log_summary(self, name):
+        """Log how much retrying the fetches for name have needed.
+
+        We only log at warning level if there were retries, so a
+        quiet run stays quiet.
+        """
+        log = logging.warning if self.num_retries else logging.info
+        log('%s: %d fetch retries, %.1fs spent waiting to retry',
+            name, self.num_retries, self.seconds_waited)
+
+
 class DashboardClient(object):
     """Fetch URLs in the AppEngine admin interface."""
-    def __init__(self, email, password):
-        self.rpcserver = create_rpcserver(email, password)
+    def __init__(self, email, password, response_cache_dir=None,
+                 retry_policy=None):
+        """Log in to the AppEngine admin interface.
+
+        Arguments:
+          email: App Engine login email address.
+          password: Password matching email.
+          response_cache_dir: (Optional) directory to save responses in
+            so later fetches of the same URL can be conditional GETs.
+          retry_policy: (Optional) a RetryPolicy for failed fetches.
+            Its num_retries and seconds_waited say how much retrying
+            this client has done.
+        """
+        self._email = email
+        self._password = password
+        self._rpcserver = None
+        self._rpcserver_lock = threading.Lock()
+        self.response_cache_dir = response_cache_dir
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = get_circuit_breaker(APPENGINE_HOST)
+
+    @property
+    def rpcserver(self):
+        """The appengine_rpc server, created on first use."""
+        with self._rpcserver_lock:
+            if self._rpcserver is None:
+                self._rpcserver = create_rpcserver(
+                    self._email, self._password, COOKIE_CACHE_DIR)
+            return self._rpcserver
 
     def fetch(self, url):
-        for i in xrange(3):      # we'll retry up to 3 times
+        return self._call_with_retries(
+            url, lambda: fetch_contents(self.rpcserver, url,
+                                        self.response_cache_dir, self._email))
+
+    def open(self, url):
+        """Like fetch(), but return an iterator over the body's lines.
+
+        The body is read from the network as the lines are consumed,
+        so it's never all in memory at once.  We only retry failures
+        to start the download, and don't use the response cache.
+        """
+        response = self._call_with_retries(
+            url, lambda: open_response(self.rpcserver, _request_path(url)))
+        return _iter_response_lines(response)
+
+    def _call_with_retries(self, url, fetch_fn):
+        """Return fetch_fn(), retrying per our RetryPolicy if it fails."""
+        start_time = time.time()
+        num_tries = 0
+        while True:
+            if not self.circuit_breaker.allow():
+                raise CircuitOpenError('Not fetching %s: too many recent '
+                                       'failures from %s'
+                                       % (url, APPENGINE_HOST))
+            num_tries += 1
             try:
-                return fetch_contents(self.rpcserver, url)
+                retval = fetch_fn()
+                self.circuit_breaker.record_success()
+                if num_tries > 1:
+                    logging.info('Fetched %s after %d tries', url, num_tries)
+                return retval
+            except UnsupportedUrlError:
+                raise
             except Exception, why:
-                time.sleep(1)
-                print 'Retrying, fetch failed: %s' % why
-                if i == 2:       # last time
+                if not self.retry_policy.should_retry(why):
+                    raise
+                self.circuit_breaker.record_failure()
+                delay = self.retry_policy.retry_delay(num_tries, start_time)
+                if delay is None:
                     raise
+                logging.warning('Retrying in %.1fs, fetch of %s failed (%s): '
+                                '%s', delay, url,
+                                self.retry_policy.classify(why), why)
+                time.sleep(delay)
+                self.retry_policy.record_retry(delay)
 
 
-def create_rpcserver(email, password):
-    """Create an instance of an RPC server to access GAE dashboard pages."""
+def create_rpcserver(email, password, cookie_cache_dir=None):
+    """Create an instance of an RPC server to access GAE dashboard pages.
+
+    If cookie_cache_dir is set, we load login cookies for this email
+    from there, if any, and save them there when we log in.  That lets
+    each cron job skip logging in as long as the cookies are valid.
+    (save_cookies=True would do something similar, but it uses a single
+    ~/.appcfg_cookies file no matter what account we log in as.)
+    """
+    gae_util.fix_sys_path()
+    from google.appengine.tools import appengine_rpc
 
     # Executing "appcfg.py update ." results in the following
     # arguments to appengine_rpc.HttpRpcServer.__init__():
@@ -83,25 +342,239 @@ def create_rpcserver(email, password):
         account_type='HOSTED_OR_GOOGLE',
         secure=True,
         rpc_tries=3)
+    rpcserver.streaming_opener = _streaming_opener(
+        rpcserver.opener, appengine_rpc.ContentEncodingHandler)
+    # Held while logging in, so threads sharing this rpcserver don't
+    # all log in at once; see _authenticate().
+    rpcserver.authenticate_lock = threading.Lock()
+    if cookie_cache_dir:
+        _load_cookies(rpcserver, email, cookie_cache_dir)
     return rpcserver
 
 
-def fetch_contents(rpcserver, url):
-    """Fetch a URL from the AppEngine admin interface."""
+def _streaming_opener(opener, content_encoding_handler_class):
+    """Return a copy of opener that leaves gzipped responses alone.
+
+    appengine_rpc's opener has a ContentEncodingHandler, which reads
+    the whole gzipped body into memory to gunzip it before returning
+    the response.  open_response() uses this opener instead, so it can
+    decompress the body as it's read.  The handlers are copied, not
+    re-created, so they share the rpcserver's cookie jar.
+    """
+    streaming_opener = urllib2.OpenerDirector()
+    streaming_opener.addheaders = list(opener.addheaders)
+    for handler in opener.handlers:
+        if not isinstance(handler, content_encoding_handler_class):
+            streaming_opener.add_handler(copy.copy(handler))
+    return streaming_opener
+
+
+def _load_cookies(rpcserver, email, cookie_cache_dir):
+    """Set up rpcserver to use the cookie file for email, and load it."""
+    if not os.path.isdir(cookie_cache_dir):
+        os.makedirs(cookie_cache_dir, 0700)
+    filename = os.path.join(cookie_cache_dir, '%s_%s.cookies'
+                            % (email.replace(os.sep, '_'), APPENGINE_HOST))
+    rpcserver.cookie_jar.filename = filename
+    if os.path.exists(filename):
+        try:
+            rpcserver.cookie_jar.load()
+            # If these cookies have expired, open_response() will
+            # get a 401 or 302 and log in again.
+            rpcserver.authenticated = True
+        except (IOError, cookielib.LoadError), why:
+            logging.warning('Ignoring bad cookie file %s: %s', filename, why)
+
+
+def _authenticate(rpcserver, only_if_needed=False):
+    """Log in, and save the new cookies if we're caching them.
+
+    If only_if_needed is True, do nothing if we're already logged in
+    (perhaps by another thread sharing this rpcserver).  Logins for
+    different rpcservers don't wait for each other.
+
+    We write via rename, since other processes may be reading the
+    cookie file, and make it readable only by us.
+    """
+    with rpcserver.authenticate_lock:
+        if only_if_needed and rpcserver.authenticated:
+            return
+        rpcserver._Authenticate()
+        filename = rpcserver.cookie_jar.filename
+        if filename:
+            with state_util.atomic_replace(filename, private=True) as tmpfile:
+                rpcserver.cookie_jar.save(tmpfile)
+
+
+def _response_cache_path(response_cache_dir, email, request_path):
+    """The file where we cache the response for email to fetch a path.
+
+    The key includes the account, since two accounts can see different
+    contents at the same URL.
+    """
+    basename = hashlib.sha1('%s %s%s' % (email, APPENGINE_HOST, request_path))
+    return os.path.join(response_cache_dir, basename.hexdigest())
+
+
+def _read_cached_response(response_cache_dir, email, request_path):
+    """Return (validators, body) for a cached response, or (None, None).
+
+    validators is a dict holding one or both of 'etag' and
+    'last_modified', the values of those headers on the response.
+    """
+    filename = _response_cache_path(response_cache_dir, email, request_path)
+    try:
+        with open(filename, 'rb') as f:
+            validators = json.loads(f.readline())
+            return (validators, f.read())
+    except (IOError, ValueError):
+        return (None, None)
+
 
-    # Determine the request path. It's OK if this has a query string.
+def _write_cached_response(response_cache_dir, email, request_path,
+                           validators, body):
+    """Save a response so we can revalidate it on the next fetch.
+
+    The validators go on the first line of the file and the body after
+    it, so a single rename replaces both: a concurrent reader never
+    sees one response's ETag with another response's body.  The admin
+    pages are private, so the cache is only readable by us.
+    """
+    if not os.path.isdir(response_cache_dir):
+        os.makedirs(response_cache_dir, 0700)
+    filename = _response_cache_path(response_cache_dir, email, request_path)
+    state_util.write_file(filename, '%s\n%s' % (json.dumps(validators), body),
+                          private=True)
+
+
+def _iter_response_body(response, chunk_size=64 * 1024):
+    """Yield the body of a urllib2 response in chunks, gunzipping it."""
+    if response.info().get('Content-Encoding') == 'gzip':
+        # 16 + MAX_WBITS tells zlib to expect a gzip header and trailer.
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+        decompressor = None
+    while True:
+        chunk = response.read(chunk_size)
+        if not chunk:
+            break
+        if decompressor:
+            chunk = decompressor.decompress(chunk)
+        if chunk:
+            yield chunk
+    if decompressor:
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk
+
+
+def _iter_response_lines(response):
+    """Yield the lines of a urllib2 response's body, then close it."""
+    try:
+        partial_line = ''
+        for chunk in _iter_response_body(response):
+            lines = (partial_line + chunk).splitlines(True)
+            if lines[-1].endswith('\n'):
+                partial_line = ''
+            else:
+                partial_line = lines.pop()
+            for line in lines:
+                yield line
+        if partial_line:
+            yield partial_line
+    finally:
+        response.close()
+
+
+def open_response(rpcserver, request_path, headers=None):
+    """Send a GET for request_path and return the urllib2 response.
+
+    Unlike rpcserver.Send(), which always reads the whole (possibly
+    uncompressed) body into memory, this lets us set request headers
+    and read the response headers and body ourselves.  We ask for a
+    gzipped response; use _iter_response_body() to read it.  The
+    rpcserver must come from create_rpcserver(), for its
+    streaming_opener and authenticate_lock.
+
+    Raises urllib2.HTTPError for non-2xx responses, including 304.
+    """
+    if not rpcserver.authenticated:
+        _authenticate(rpcserver, only_if_needed=True)
+    url = '%s://%s%s' % (rpcserver.scheme, rpcserver.host, request_path)
+    for auth_try in xrange(2):
+        request = rpcserver._CreateRequest(url=url)
+        request.add_header('Accept-Encoding', 'gzip')
+        # Google only gzips responses if the user-agent mentions gzip
+        # (appengine_rpc's ContentEncodingHandler does this too).
+        request.add_header('User-agent', '%s gzip' % request.get_header(
+            'User-agent', USER_AGENT))
+        for (header, value) in (headers or {}).iteritems():
+            request.add_header(header, value)
+        try:
+            return rpcserver.streaming_opener.open(request)
+        except urllib2.HTTPError, why:
+            # Our login cookie has expired: log in again and retry.
+            if why.code in (401, 302) and auth_try == 0:
+                _authenticate(rpcserver)
+                continue
+            raise
+
+
+def _request_path(url):
+    """The path (and query string) to request on APPENGINE_HOST for url."""
     valid_host_prefix = 'https://%s' % APPENGINE_HOST
     if url.startswith('/'):
         # Treat input as a server-relative path on APPENGINE_HOST.
-        request_path = url
+        return url
     elif url.startswith(valid_host_prefix):
-        request_path = url[len(valid_host_prefix):]
+        return url[len(valid_host_prefix):]
     else:
         raise UnsupportedUrlError(
             'URL to fetch must start with / or %s/. Saw %s' %
             (valid_host_prefix, url))
 
-    return rpcserver.Send(request_path, None)
+
+def fetch_contents(rpcserver, url, response_cache_dir=None, email=None):
+    """Fetch a URL from the AppEngine admin interface.
+
+    If response_cache_dir is set, we revalidate any response we have
+    cached for this URL and return the cached copy if it's unchanged.
+    Responses are cached per email, the account rpcserver logs in as.
+    """
+    # It's OK if the request path has a query string.
+    request_path = _request_path(url)
+
+    headers = {}
+    if response_cache_dir:
+        (validators, cached_body) = _read_cached_response(response_cache_dir,
+                                                          email, request_path)
+        if validators and 'etag' in validators:
+            headers['If-None-Match'] = validators['etag']
+        if validators and 'last_modified' in validators:
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    try:
+        response = open_response(rpcserver, request_path, headers)
+    except urllib2.HTTPError, why:
+        if why.code == 304 and headers:
+            return cached_body
+        raise
+    try:
+        body = ''.join(_iter_response_body(response))
+    finally:
+        response.close()
+
+    if response_cache_dir:
+        response_headers = response.info()
+        validators = {}
+        if response_headers.get('ETag'):
+            validators['etag'] = response_headers['ETag']
+        if response_headers.get('Last-Modified'):
+            validators['last_modified'] = response_headers['Last-Modified']
+        if validators:
+            _write_cached_response(response_cache_dir, email,
+                                   request_path, validators, body)
+    return body
 
 
 def main():
@@ -29,6 +29,7 @@ import json
 import logging
 import string
 import sys
+import threading
 
 import gae_dashboard_curl
 import parsers
@@ -39,6 +40,7 @@ _SCRAPE_TABLE = [
     'deployment.default_version',
     'instance_summary.summaries',
     'instance_summary.summary',
+    'instances.details',
     'memcache.statistics',
     ]
 
@@ -62,7 +64,8 @@ def _name_parser(name):
     return ('/%s' % parser_name, getattr(parsers, parser_class_name), method)
 
 
-def scrape(email, password, appid, names, module=None, version=None):
+def scrape(email, password, appid, names, module=None, version=None,
+           dashclient=None, keep_text=False):
     """Scrape data for each name in names.
 
     Arguments:
@@ -74,32 +77,89 @@ def scrape(email, password, appid, names, module=None, version=None):
         version_id query parameter.
       version: (Optional). When scraping, reference this version in the
         version_id query parameter.
+      dashclient: (Optional). A gae_dashboard_curl.DashboardClient to
+        fetch with, so callers can share one.  By default we log in
+        with email and password, and revalidate pages saved in
+        gae_dashboard_curl.RESPONSE_CACHE_DIR.
+      keep_text: (Optional). If True, parsers.Value objects in the
+        result keep the scraped text as well as the parsed value.
 
     Returns:
       A dict whose keys are the passed-in names and whose values are
     the corresponding return values from the parsers in the parsers
     module.
 
+    """
+    return scrape_many(email, password, appid, names, [module],
+                       version=version, dashclient=dashclient,
+                       keep_text=keep_text)[module]
+
+
+def scrape_many(email, password, appid, names, modules, version=None,
+                dashclient=None, keep_text=False):
+    """Scrape data for each name in names, for each module in modules.
+
+    This is like scrape(), but fetches every (page, module) pair
+    concurrently, all using the same DashboardClient.
+
+    Arguments:
+      modules: A list of modules to scrape.  A module may be None to
+        not reference any module in the version_id query parameter.
+      The other arguments are as for scrape().
+
+    Returns:
+      A dict whose keys are the passed-in modules and whose values are
+    dicts like scrape() returns.
+
     """
     unknown_names = set(names) - set(_SCRAPE_TABLE)
     if unknown_names:
         raise ValueError('Unknown names: %s' % sorted(unknown_names))
 
-    data = {}
-    dashclient = gae_dashboard_curl.DashboardClient(email, password)
+    if dashclient is None:
+        dashclient = gae_dashboard_curl.DashboardClient(
+            email, password,
+            response_cache_dir=gae_dashboard_curl.RESPONSE_CACHE_DIR)
 
     # Pages may contain multiple pieces of data. Fetch each page once.
     cache = {}
-    for name in names:
-        res, parser_class, method_name = _name_parser(name)
-        parser_key = (res, parser_class)
-        if not parser_key in cache:
+    for module in modules:
+        for name in names:
+            res, parser_class, method_name = _name_parser(name)
+            cache[(module, res, parser_class)] = None
+
+    def fetch_page(parser_key):
+        (module, res, parser_class) = parser_key
+        try:
             url = _build_dashboard_url(res, appid, module=module,
                                        version=version)
             logging.info('Fetching %s' % url)
-            cache[parser_key] = parser_class(dashclient.fetch(url))
-        logging.info('Reading %s' % name)
-        data[name] = getattr(cache[parser_key], method_name)()
+            cache[parser_key] = parser_class(dashclient.fetch(url),
+                                             fast=True,
+                                             keep_text=keep_text)
+        except Exception:
+            # Exceptions in threads are swallowed, so save it for later.
+            cache[parser_key] = sys.exc_info()
+
+    threads = [threading.Thread(target=fetch_page, args=(parser_key,))
+               for parser_key in cache]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for parser in cache.itervalues():
+        if isinstance(parser, tuple):     # the sys.exc_info() of a failure
+            raise parser[0], parser[1], parser[2]
+
+    data = {}
+    for module in modules:
+        data[module] = {}
+        for name in names:
+            res, parser_class, method_name = _name_parser(name)
+            logging.info('Reading %s' % name)
+            data[module][name] = getattr(cache[(module, res, parser_class)],
+                                         method_name)()
     return data
 
 
@@ -237,7 +297,8 @@ def main():
                      args.application,
                      args.names,
                      module=args.module,
-                     version=args.version)
+                     version=args.version,
+                     keep_text=args.raw_values)
     if args.format == 'text':
         _write_text_format(scraped, raw_values=args.raw_values)
     elif args.format == 'json':
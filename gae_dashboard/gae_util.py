@@ -1,9 +1,25 @@
 """Miscellaneous utilities for interacting with GAE."""
 
 import cStringIO
+import collections
+import json
 import os
 import re
 import sys
+import threading
+import time
+
+import state_util
+
+
+# Where we remember the result of _discover_sdk_path(), since scanning
+# every directory on $PATH is slow.
+_SDK_PATH_CACHE = os.path.join(os.getenv('HOME'), 'gae_sdk_path.cache')
+
+
+def _is_sdk_path(path):
+    return (os.path.isfile(os.path.join(path, 'dev_appserver.py')) and
+            os.path.isdir(os.path.join(path, 'google', 'appengine')))
 
 
 def _discover_sdk_path():
@@ -15,6 +31,13 @@ def _discover_sdk_path():
     # appengine location on toby as the last-ditch option.
     os.environ['PATH'] += ':/usr/local/google_appengine'
 
+    # Use the path we found last time, if the SDK is still there.
+    if os.path.exists(_SDK_PATH_CACHE):
+        with open(_SDK_PATH_CACHE) as f:
+            path = f.read().strip()
+        if _is_sdk_path(path):
+            return path
+
     # Poor-man's `which` command.
     for path in os.environ['PATH'].split(':'):
         if os.path.isdir(path) and 'dev_appserver.py' in os.listdir(path):
@@ -27,14 +50,26 @@ def _discover_sdk_path():
 
     # Verify the App Engine installation directory looks right.
     assert os.path.isdir(os.path.join(path, 'google', 'appengine')), path
+
+    state_util.write_file(_SDK_PATH_CACHE, path + '\n')
     return path
 
 
+# Held while fixing sys.path, since each thread's first fetch calls
+# fix_sys_path() and it must only do its work once.
+_fix_sys_path_lock = threading.Lock()
+
+
 def fix_sys_path(appengine_sdk_dir=None):
     """Update sys.path for appengine khan academy imports, also envvars."""
-    if 'dev_appserver' in sys.modules:      # we've already fixed the path!
-        return
+    with _fix_sys_path_lock:
+        if 'dev_appserver' in sys.modules:  # we've already fixed the path!
+            return
+        _fix_sys_path(appengine_sdk_dir)
 
+
+def _fix_sys_path(appengine_sdk_dir):
+    """The work of fix_sys_path(); the caller holds _fix_sys_path_lock."""
     # This was originally copied  webapp/tools/appengine_tool_setup.py
 
     if 'SERVER_SOFTWARE' not in os.environ:
@@ -67,26 +102,205 @@ def fix_sys_path(appengine_sdk_dir=None):
     dev_appserver.fix_sys_path()
 
 
-def get_modules(email, password, app_id):
-    """Return a list of all modules that our GAE instance knows of."""
+# Where get_modules() caches the modules for each app-id, and for how
+# long.  Modules are rarely added or removed, so this can be long.
+_MODULES_CACHE = os.path.join(os.getenv('HOME'), 'gae_modules.cache')
+_MODULES_CACHE_TTL_SECONDS = 6 * 60 * 60
+
+# The in-memory copy of _MODULES_CACHE: app_id -> (time_t, modules).
+_modules_cache = {}
+_modules_cache_lock = threading.Lock()
+# app_ids for which a background refresh is running.
+_modules_refreshing = set()
+
+
+def _read_modules_cache():
+    """Return the on-disk modules cache, app_id -> (time_t, modules)."""
+    try:
+        with open(_MODULES_CACHE) as f:
+            cache = json.load(f, object_pairs_hook=collections.OrderedDict)
+    except (IOError, ValueError):
+        return {}
+    retval = {}
+    for (app_id, (time_t, versions)) in cache.iteritems():
+        if not isinstance(versions, dict):
+            continue      # from an older version of this code; refetch
+        retval[app_id] = (time_t, collections.OrderedDict(
+            (str(module), [str(v) for v in module_versions])
+            for (module, module_versions) in versions.iteritems()))
+    return retval
+
+
+def _write_modules_cache(app_id, time_t, modules):
+    """Update the entry for app_id in the memory and on-disk caches."""
+    with _modules_cache_lock:
+        _modules_cache[app_id] = (time_t, modules)
+        on_disk = _read_modules_cache()
+        on_disk[app_id] = (time_t, modules)
+        # Concurrent cron jobs must never see half a file.
+        state_util.write_file(_MODULES_CACHE, json.dumps(on_disk))
+
+
+def _refresh_modules_cache(email, password, app_id):
+    """Fetch the modules for app_id and store them in the cache."""
+    try:
+        modules = _list_modules(email, password, app_id)
+        _write_modules_cache(app_id, time.time(), modules)
+        return modules
+    finally:
+        with _modules_cache_lock:
+            _modules_refreshing.discard(app_id)
+
+
+def get_modules(email, password, app_id,
+                max_age_seconds=_MODULES_CACHE_TTL_SECONDS, refresh=False):
+    """Return all the modules that our GAE instance knows of.
+
+    Returns an OrderedDict mapping each module name to a list of its
+    deployed versions.  Iterating over it gives the module names.
+
+    Listing the modules is slow, so we cache the result in memory and
+    on disk.  If the cached list is older than max_age_seconds we
+    still return it, but fetch a new list in a background thread,
+    which we don't wait for at exit.
+    Only if there is no cached list at all do we wait for the fetch.
+
+    If refresh is True, we always fetch a new list and wait for it.
+    Do that before relying on the list being up to date, e.g. before
+    deciding a version isn't deployed.
+    """
+    with _modules_cache_lock:
+        if app_id not in _modules_cache:
+            _modules_cache.update(_read_modules_cache())
+        cached = None if refresh else _modules_cache.get(app_id)
+        if cached is None:
+            _modules_refreshing.add(app_id)
+        elif (time.time() - cached[0] > max_age_seconds and
+                app_id not in _modules_refreshing):
+            _modules_refreshing.add(app_id)
+            # This is a daemon thread, so a slow or hung appcfg can't
+            # keep us from exiting.  If we exit first, the cache is
+            # left as it was (it's replaced atomically), and the next
+            # run tries again.
+            thread = threading.Thread(target=_refresh_modules_cache,
+                                      args=(email, password, app_id))
+            thread.daemon = True
+            thread.start()
+
+    if cached is None:
+        return _refresh_modules_cache(email, password, app_id)
+    return cached[1]
+
+
+class _ModuleVersionsParser(object):
+    """A file-like object that parses `appcfg.py list_versions` output.
+
+    appcfg.py writes a yaml map from module name to a list of versions,
+    usually in "flow" style, which may wrap onto following lines:
+
+      default: [0501-abc, 0502-def,
+        0503-ghi]
+      frontend-highmem: [0502-def]
+
+    but possibly in "block" style:
+
+      default:
+      - 0501-abc
+
+    We parse each line as it's written, ignoring lines that are not
+    part of the map, and collect the result in self.versions, an
+    OrderedDict from module name to a list of version names.  Anything
+    that is not part of the map is kept in self.other_output, which is
+    useful for error messages.
+    """
+    _FLOW_START_RE = re.compile(r'^(\S+):\s*\[(.*)$')
+    _BLOCK_START_RE = re.compile(r'^(\S+):\s*$')
+    _BLOCK_ITEM_RE = re.compile(r'^\s*-\s+(\S+)\s*$')
+
+    def __init__(self):
+        self.versions = collections.OrderedDict()
+        self.other_output = []
+        self._partial_line = ''
+        self._module = None       # the module whose versions we're reading
+        self._in_flow_list = False
+
+    def write(self, s):
+        lines = (self._partial_line + s).split('\n')
+        self._partial_line = lines.pop()
+        for line in lines:
+            self._parse_line(line)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._partial_line:
+            self._parse_line(self._partial_line)
+            self._partial_line = ''
+
+    def _add_versions(self, flow_list_text):
+        """Add versions from the text of a flow list, return True at ']'."""
+        (flow_list_text, end, _) = flow_list_text.partition(']')
+        for version in flow_list_text.split(','):
+            version = version.strip().strip('\'"')
+            if version:
+                self.versions[self._module].append(version)
+        return bool(end)
+
+    def _parse_line(self, line):
+        if self._in_flow_list:
+            self._in_flow_list = not self._add_versions(line)
+            return
+
+        m = self._FLOW_START_RE.match(line)
+        if m:
+            self._module = m.group(1)
+            self.versions[self._module] = []
+            self._in_flow_list = not self._add_versions(m.group(2))
+            return
+
+        m = self._BLOCK_START_RE.match(line)
+        if m:
+            self._module = m.group(1)
+            self.versions[self._module] = []
+            return
+
+        m = self._BLOCK_ITEM_RE.match(line)
+        if m and self._module:
+            self.versions[self._module].append(m.group(1).strip('\'"'))
+            return
+
+        self._module = None
+        self.other_output.append(line)
+
+
+def _list_modules(email, password, app_id):
+    """Ask appcfg.py for all the modules that our GAE instance knows of.
+
+    Returns an OrderedDict mapping module name to a list of its
+    deployed versions.
+
+    Only appcfg's stdout is parsed: its log and error messages go to
+    stderr, and a line there like "Error: [Errno 111]" would otherwise
+    look like a module.
+    """
     fix_sys_path()
     from google.appengine.tools import appcfg
-    output = cStringIO.StringIO()
+    output = _ModuleVersionsParser()
+    errors = cStringIO.StringIO()
     argv = ['appcfg.py', '--skip_sdk_update_check',
             'list_versions', '-A', app_id]
     app = appcfg.AppCfgApp(argv,
                            password_input_fn=lambda prompt: password,
                            raw_input_fn=lambda prompt: email,
-                           out_fh=output, error_fh=output)
+                           out_fh=output, error_fh=errors)
     rc = app.Run()
+    output.close()
     if rc != 0:
-        raise RuntimeError("appcfg.py returned error code %s:\n%s"
-                           % (rc, output.getvalue()))
-
-    # The output is some yaml-like format.  We do a cheesy parse of it:
-    # the module names are all of the form 'module_name: [...'
-    modules = re.findall(r'(\S+): \[', output.getvalue())
+        raise RuntimeError("appcfg.py returned error code %s:\n%s%s"
+                           % (rc, errors.getvalue(),
+                              '\n'.join(output.other_output)))
 
     # Special case: we don't want to reutrn the test 'vm' module
-    return [m for m in modules if m != 'vm']
-
+    output.versions.pop('vm', None)
+    return output.versions
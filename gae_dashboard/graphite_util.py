@@ -101,25 +101,23 @@ def maybe_send_to_graphite(graphite_host, category, records, module=None):
 
     epoch = datetime.datetime.utcfromtimestamp(0)
 
+    if module:
+        module_component = '.%s' % module.replace('-', '_') + '_module'
+    else:
+        module_component = ''
+    key_prefix = ('%s.webapp.gae.dashboard.%s%s.'
+                  % (api_key, category, module_component))
+
     # The format of the pickle-protocol data is described at:
     # http://graphite.readthedocs.org/en/latest/feeding-carbon.html#the-pickle-protocol
     graphite_data = []
     for record in records:
-        record = record.copy()    # since we're munging it in place
-
-        timestamp = record.pop('utc_datetime')
         # Convert the timestamp to a time_t.
-        timestamp = int((timestamp - epoch).total_seconds())
+        timestamp = int((record['utc_datetime'] - epoch).total_seconds())
 
         for (field, value) in record.iteritems():
-            if module:
-                module_component = '.%s' % module.replace('-', '_') + '_module'
-            else:
-                module_component = ''
-            key = ('%s.webapp.gae.dashboard.%s%s.%s'
-                   % (api_key, category, module_component, field))
-
-            graphite_data.append((key, (timestamp, value)))
+            if field != 'utc_datetime':
+                graphite_data.append((key_prefix + field, (timestamp, value)))
 
     if graphite_data:
         (hostname, port_string) = graphite_host.split(':')
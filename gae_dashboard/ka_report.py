@@ -22,12 +22,34 @@ Data from /instance_summary are sent to graphite with the prefix
   average_latency_ms: FLOAT
   average_memory_mb: FLOAT
 
+Data from /instances are sent with the same prefix.  The averages
+above can hide a few slow or bloated instances, so we also send the
+distribution over each module's instances:
+
+  utc_datetime: DATETIME
+  latency_ms_p50, latency_ms_p90, latency_ms_p99: FLOAT
+  memory_mb_p50, memory_mb_p90, memory_mb_p99: FLOAT
+  num_instances_age_under_1h: INTEGER
+  num_instances_age_under_6h: INTEGER
+  num_instances_age_under_1d: INTEGER
+  num_instances_age_under_7d: INTEGER
+  num_instances_age_over_7d: INTEGER
+
+The age histogram buckets don't overlap: num_instances_age_under_6h
+counts the instances that are between 1 hour and 6 hours old.
+
+The latency percentiles are omitted if no instance's latency is known,
+and all the percentiles are omitted if the module has no instances.
+
 """
 
 import argparse
+import bisect
 import datetime
+import math
 import sys
 
+import gae_dashboard_curl
 import gae_dashboard_scrape
 import gae_util
 import graphite_util
@@ -59,6 +81,85 @@ def report_instance_summary(summary, module, download_dt, graphite_host,
                                              [record], module=module)
 
 
+# The upper bounds, in seconds, of the instance-age histogram buckets,
+# and their names.  Instances older than the last bound are counted
+# in num_instances_age_over_<last name>.
+_AGE_BUCKETS = [(60 * 60, '1h'),
+                (6 * 60 * 60, '6h'),
+                (24 * 60 * 60, '1d'),
+                (7 * 24 * 60 * 60, '7d'),
+                ]
+
+_PERCENTILES = (50, 90, 99)
+
+
+def _percentile(sorted_values, percentile):
+    """The nearest-rank percentile of a non-empty sorted list."""
+    rank = int(math.ceil(len(sorted_values) * percentile / 100.0))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def instance_distribution(details):
+    """Summarize per-instance statistics as percentiles and a histogram.
+
+    Arguments:
+      details: List returned by parsers.Instances.details().
+
+    Returns:
+      A dict with the fields described in the module docstring (other
+      than utc_datetime).
+    """
+    # Pull out each column in one pass over the instances, then sort
+    # each column once to read off all its percentiles.
+    latencies = []
+    memories = []
+    age_counts = [0] * (len(_AGE_BUCKETS) + 1)
+    age_bounds = [bound for (bound, _) in _AGE_BUCKETS]
+    for d in details:
+        if 'latency' in d:
+            latencies.append(d['latency'].value())
+        memories.append(d['memory'].value())
+        age_counts[bisect.bisect_right(age_bounds, d['age'].value())] += 1
+
+    distribution = {}
+    for (name, values) in (('latency_ms', latencies),
+                           ('memory_mb', memories)):
+        if not values:
+            continue
+        values.sort()
+        for percentile in _PERCENTILES:
+            distribution['%s_p%d' % (name, percentile)] = float(
+                _percentile(values, percentile))
+    for (i, (_, bucket_name)) in enumerate(_AGE_BUCKETS):
+        distribution['num_instances_age_under_%s' % bucket_name] = (
+            age_counts[i])
+    distribution['num_instances_age_over_%s' % _AGE_BUCKETS[-1][1]] = (
+        age_counts[-1])
+    return distribution
+
+
+def report_instance_distribution(details, module, download_dt,
+                                 graphite_host, verbose=False, dry_run=False):
+    """Send the distribution of per-instance statistics to graphite.
+
+    Arguments:
+      details: List returned by parsers.Instances.details().
+      module: the name of the GAE module that these instances are in.
+      download_dt: Datetime when /instances was downloaded.
+      graphite_host: host:port of graphite server to send data to, or ''/None
+      verbose: If True, print report to stdout.
+      dry_run: If True, do not store report in the database.
+    """
+    record = instance_distribution(details)
+    record['utc_datetime'] = download_dt
+    if verbose:
+        print record
+
+    if not dry_run:
+        graphite_util.maybe_send_to_graphite(graphite_host, 'instances',
+                                             [record], module=module)
+
+
 def report_memcache_statistics(stats, download_dt, graphite_host,
                                verbose=False, dry_run=False):
     """Store memcache statistics in mongo and maybe graphite.
@@ -92,30 +193,57 @@ def main(email, password, application, version, graphite_host,
          verbose=False, dry_run=False):
     download_dt = datetime.datetime.utcnow()
 
-    # Get the per-module stats.
-    for module in gae_util.get_modules(email, password, application):
+    # Get the per-module stats.  There's nothing to scrape for modules
+    # that don't have any versions deployed (or not the one we want).
+    module_versions = gae_util.get_modules(email, password, application)
+    if version and any(version not in versions
+                       for versions in module_versions.itervalues()):
+        # The cached module list may be from before version was
+        # deployed, so get a fresh one before skipping any module.
+        module_versions = gae_util.get_modules(email, password, application,
+                                               refresh=True)
+    modules = []
+    for (module, versions) in module_versions.iteritems():
+        if not versions or (version and version not in versions):
+            if verbose:
+                print '-- Skipping module %s: no version to scrape' % module
+            continue
+        modules.append(module)
+
+    # All the modules are fetched in parallel, sharing one login.
+    dashclient = gae_dashboard_curl.DashboardClient(
+        email, password,
+        response_cache_dir=gae_dashboard_curl.RESPONSE_CACHE_DIR)
+    try:
+        if verbose:
+            print ('-- Fetching instance_summary.summary and '
+                   'instances.details for modules %s' % ', '.join(modules))
+        scraped = gae_dashboard_scrape.scrape_many(
+            email, password, application,
+            ['instance_summary.summary', 'instances.details'],
+            modules, version=version, dashclient=dashclient)
+        for module in modules:
+            report_instance_summary(
+                scraped[module]['instance_summary.summary'], module,
+                download_dt, graphite_host, verbose, dry_run)
+            report_instance_distribution(
+                scraped[module]['instances.details'], module,
+                download_dt, graphite_host, verbose, dry_run)
+
+        # Now get the global stats (the ones that are not per-instance).
         if verbose:
-            print '-- Fetching instance_summary.summary for module %s' % module
+            print '-- Fetching memcache.statistics'
         scraped = gae_dashboard_scrape.scrape(email,
                                               password,
                                               application,
-                                              ['instance_summary.summary'],
-                                              module=module,
-                                              version=version)
-        report_instance_summary(scraped['instance_summary.summary'], module,
-                                download_dt,
-                                graphite_host, verbose, dry_run)
-
-    # Now get the global stats (the ones that are not per-instance).
-    if verbose:
-        print '-- Fetching memcache.statistics'
-    scraped = gae_dashboard_scrape.scrape(email,
-                                          password,
-                                          application,
-                                          ['memcache.statistics'],
-                                          version=version)
-    report_memcache_statistics(scraped['memcache.statistics'], download_dt,
-                               graphite_host, verbose, dry_run)
+                                              ['memcache.statistics'],
+                                              version=version,
+                                              dashclient=dashclient)
+        report_memcache_statistics(scraped['memcache.statistics'],
+                                   download_dt, graphite_host, verbose,
+                                   dry_run)
+    finally:
+        dashclient.retry_policy.log_summary('ka_report')
 
 
 if __name__ == '__main__':
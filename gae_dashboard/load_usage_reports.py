@@ -3,11 +3,16 @@
 """Send statistics from App Engine's usage reports to graphite.
 
 This script reads an App Engine usage report in CSV format from stdin,
-then takes all records since the input start_date, parses them, and
-emits the data to graphite.
+or downloads it from the admin UI itself, then takes all records since
+the input start_date, parses them, and emits the data to graphite.
 
 Usage:
   ./load_usage_reports.py < billing_history.csv
+  echo PASSWORD | ./load_usage_reports.py --email=EMAIL -A APP_ID
+
+When downloading the report, we parse it as it arrives rather than
+waiting for all of it, and there's no need for a second process (like
+gae_dashboard_curl.py) to fetch it.
 
 The expected CSV input looks like what /billing/history.csv?app_id=
 returned as of October 2012:
@@ -18,21 +23,37 @@ returned as of October 2012:
   ...
 
 Records are sent to graphite under the keys webapp.gae.dashboard.usage.*
+
+With --incremental, we also remember how many bytes of input we read
+and a hash of them.  If the next input starts with exactly those
+bytes, as it does when the history has only grown at the end, we skip
+over them without parsing them.
 """
 
 import argparse
 import csv
 import datetime
+import hashlib
 import os
 import re
 import sys
 
 import pytz
 
+import gae_dashboard_curl
 import graphite_util
+import state_util
+
+
+# A run holds _LAST_RECORD_DB.locked() while it uses either of these.
+_LAST_RECORD_DB = state_util.State(
+    os.path.join(os.getenv('HOME'), 'usage_report_time.db'))
 
+_INGESTED_PREFIX_DB = state_util.State(
+    os.path.join(os.getenv('HOME'), 'usage_report_prefix.json'))
 
-_LAST_RECORD_DB = os.path.join(os.getenv('HOME'), 'usage_report_time.db')
+# All appengine dates are pacific time, I've been informed.
+_PACIFIC_TZ = pytz.timezone('America/Los_Angeles')
 
 
 def _time_t_of_latest_record():
@@ -44,18 +65,85 @@ def _time_t_of_latest_record():
         The time_t (# of seconds since the UNIX epoch) or None if
         there is no previous record.
     """
-    if os.path.exists(_LAST_RECORD_DB):
-        with open(_LAST_RECORD_DB) as f:
-            return int(f.read().strip())
-    return None
+    return _LAST_RECORD_DB.read()
 
 
 def _write_time_t_of_latest_record(records):
-    """Find the record with the latest time-t and write it to the db."""
+    """Find the record with the latest time-t and write it to the db.
+
+    If the db already has a later time_t, we leave it alone.
+    """
     epoch = datetime.datetime.utcfromtimestamp(0)
     latest_record = max(records, key=lambda r: r['utc_datetime'])
-    with open(_LAST_RECORD_DB, 'w') as f:
-        print >>f, int((latest_record['utc_datetime'] - epoch).total_seconds())
+    time_t = int((latest_record['utc_datetime'] - epoch).total_seconds())
+    old_time_t = _time_t_of_latest_record()
+    if old_time_t is None or time_t > old_time_t:
+        _LAST_RECORD_DB.write(time_t)
+
+
+def _read_ingested_prefix():
+    """The (length, sha1 hexdigest) of the input we imported last time.
+
+    Returns (0, None) if we haven't stored one.
+    """
+    prefix = _INGESTED_PREFIX_DB.read()
+    if prefix is None:
+        return (0, None)
+    return (prefix['length'], prefix['sha1'])
+
+
+def _write_ingested_prefix(length, sha1):
+    """Write the length and sha1 hexdigest of the imported input to the db."""
+    _INGESTED_PREFIX_DB.write({'length': length, 'sha1': sha1})
+
+
+class _UnimportedLines(object):
+    """Iterate over the lines of the CSV input we haven't imported yet.
+
+    The header line is always included.  If the input starts with the
+    same prefix_length bytes as last time (according to prefix_sha1),
+    we skip the rest of them; otherwise we return all the lines.  As
+    we go, we keep track of the length and sha1 of the input read so
+    far, to store for next time.  A final line without a newline may
+    be incomplete, so it's never counted as read.
+    """
+    def __init__(self, lines, prefix_length, prefix_sha1):
+        self._lines = iter(lines)
+        self.header = next(self._lines, '')
+        self.length = len(self.header)
+        self.sha1 = hashlib.sha1(self.header)
+
+        # Read lines until we've read as much as we did last time.
+        self._prefix_lines = []
+        while self.length < prefix_length:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._prefix_lines.append(line)
+            if not line.endswith('\n'):
+                break
+            self.length += len(line)
+            self.sha1.update(line)
+        self.skipped = (prefix_sha1 is not None and
+                        self.length == prefix_length and
+                        self.sha1.hexdigest() == prefix_sha1)
+        if self.skipped:
+            self._prefix_lines = []
+
+    def __iter__(self):
+        yield self.header
+        for line in self._prefix_lines:
+            yield line
+        for line in self._lines:
+            if line.endswith('\n'):
+                self.length += len(line)
+                self.sha1.update(line)
+            yield line
+
+
+# The same few resource names appear every day, so we only munge
+# each one once.  See _munge_key().
+_munged_keys = {}
 
 
 def _munge_key(key):
@@ -67,10 +155,27 @@ def _munge_key(key):
     search_document_storage and dedicated_memcache, which is not
     great but much better.
     """
-    # Ignore any parentheticals.
-    key = re.sub('[^\w\s].*', '', key)
-    key = re.sub('\s+', '_', key.strip())
-    return key.lower()
+    if key not in _munged_keys:
+        # Ignore any parentheticals.
+        munged_key = re.sub('[^\w\s].*', '', key)
+        munged_key = re.sub('\s+', '_', munged_key.strip())
+        _munged_keys[key] = munged_key.lower()
+    return _munged_keys[key]
+
+
+def _records_by_day(reports):
+    """Merge (<date>, <key>, <value>) usage reports into a record per day.
+
+    Returns a list of dicts, each with a 'utc_datetime' field and a
+    field for each (munged) key reported for that day, in date order.
+    If two keys on a day munge to the same name, the later one wins.
+    """
+    records_by_dt = {}
+    for (dt, key, value) in reports:
+        if dt not in records_by_dt:
+            records_by_dt[dt] = {'utc_datetime': dt}
+        records_by_dt[dt][_munge_key(key)] = value
+    return [records_by_dt[dt] for dt in sorted(records_by_dt)]
 
 
 def _reports_since_dt(csvreader, cutoff_dt):
@@ -89,7 +194,8 @@ def _reports_since_dt(csvreader, cutoff_dt):
       For example:
          (datetime.datetime(2012, 10, 15, 0, 0, 0), 'Frontend', 31000.23)
     """
-    seen_dts = set()
+    # Many rows share a date, so we only convert each date once.
+    utc_dts = {}
     for row in csvreader:
         if not row:
             # Skip blank lines.
@@ -103,39 +209,42 @@ def _reports_since_dt(csvreader, cutoff_dt):
         if row['Date'] <= cutoff_dt:
             continue
 
-        if row['Date'] not in seen_dts:
+        dt = utc_dts.get(row['Date'])
+        if dt is None:
             print 'Found usage report for: %s' % row['Date']
-            seen_dts.add(row['Date'])
+            dt = datetime.datetime.strptime(row['Date'], '%Y-%m-%d')
+            dt -= _PACIFIC_TZ.utcoffset(dt)
+            utc_dts[row['Date']] = dt
 
         used_str = row['Used'].replace(',', '')  # float() can't parse a comma
         used_num = float(used_str) if '.' in used_str else int(used_str)
-        dt = datetime.datetime.strptime(row['Date'], '%Y-%m-%d')
-        # All appengine dates are pacific time, I've been informed, so
-        # we set the tzinfo using that.
-        dt -= pytz.timezone('America/Los_Angeles').utcoffset(dt)
         yield (dt, row['Name'], used_num)
 
 
-def main(csv_iter):
-    """Parse App Engine usage report CSV and bring a mongo db collection
-    up-to-date with it.
+def import_usage_reports(csv_iter, graphite_host, verbose=False,
+                         dry_run=False, incremental=False):
+    """Send the usage reports we haven't already sent to graphite.
 
-    csv_input is any object that returns a line of the usage report CSV for
-    each iteration. This includes the header line containing field names.
+    Arguments:
+      csv_iter: an iterable over the lines of the usage report CSV,
+        starting with the header line.
+      graphite_host: host:port of graphite server to send data to, or ''/None
+      verbose: If True, print report to stdout.
+      dry_run: If True, do not store report in the database.
+      incremental: If True, skip the lines of csv_iter that we read last
+        time, if they haven't changed.  See _UnimportedLines.
+
+    Callers should hold _LAST_RECORD_DB.locked().
     """
-    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', 1)[0])
-    parser.add_argument('--graphite_host',
-                        default='carbon.hostedgraphite.com:2004',
-                        help=('host:port to send stats to graphite '
-                              '(using the pickle protocol). '
-                              '[default: %(default)s]'))
-    parser.add_argument('-v', '--verbose', action='store_true', default=False,
-                        help='print report on stdout')
-    parser.add_argument('-n', '--dry-run', action='store_true', default=False,
-                        help='do not store report in the database')
-    args = parser.parse_args()
-
-    csvreader = csv.DictReader(csv_iter)
+    if incremental:
+        (prefix_length, prefix_sha1) = _read_ingested_prefix()
+        csv_lines = _UnimportedLines(csv_iter, prefix_length, prefix_sha1)
+        if csv_lines.skipped:
+            print 'Skipping the %s bytes of input imported last time' % (
+                prefix_length)
+    else:
+        csv_lines = csv_iter
+    csvreader = csv.DictReader(csv_lines)
 
     start_date = _time_t_of_latest_record()
     if start_date is None:
@@ -147,25 +256,81 @@ def main(csv_iter):
 
     print 'Importing usage reports starting from %s' % start_date
 
-    records_to_add = []
-    for (dt, key, value) in _reports_since_dt(csvreader, start_date):
-        records_to_add.append({'utc_datetime': dt, _munge_key(key): value})
+    # We send a single record for each day, with all its usage fields.
+    records_to_add = _records_by_day(_reports_since_dt(csvreader, start_date))
 
-    if args.verbose:
+    if verbose:
         print records_to_add
 
-    print 'Importing %s documents' % len(records_to_add)
+    print 'Importing %s documents (one per day)' % len(records_to_add)
 
-    if args.dry_run:
+    if dry_run:
         print 'Skipping import during dry-run.'
         records_to_add = []
     elif records_to_add:
-        graphite_util.maybe_send_to_graphite(args.graphite_host, 'usage',
+        graphite_util.maybe_send_to_graphite(graphite_host, 'usage',
                                              records_to_add)
 
     if records_to_add:
         _write_time_t_of_latest_record(records_to_add)
 
+    if incremental and not dry_run:
+        _write_ingested_prefix(csv_lines.length, csv_lines.sha1.hexdigest())
+
+
+def main(csv_iter=None):
+    """Parse App Engine usage report CSV and bring a mongo db collection
+    up-to-date with it.
+
+    csv_input is any object that returns a line of the usage report CSV for
+    each iteration. This includes the header line containing field names.
+    If it's None, we download the CSV if --email was given, or else read
+    it from stdin.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', 1)[0])
+    parser.add_argument('--graphite_host',
+                        default='carbon.hostedgraphite.com:2004',
+                        help=('host:port to send stats to graphite '
+                              '(using the pickle protocol). '
+                              '[default: %(default)s]'))
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help='print report on stdout')
+    parser.add_argument('-n', '--dry-run', action='store_true', default=False,
+                        help='do not store report in the database')
+    parser.add_argument('--incremental', action='store_true', default=False,
+                        help=('skip the input we imported last time, if '
+                              'it is unchanged'))
+    parser.add_argument('-e', '--email', metavar='EMAIL',
+                        help=('download the usage report, logging in as '
+                              'this user with the password on stdin'))
+    parser.add_argument('-A', '--application', metavar='APP_ID',
+                        help=('the application to download the report for, '
+                              'e.g. s~khan-academy'))
+    args = parser.parse_args()
+
+    dashclient = None
+    if csv_iter is None:
+        if args.email:
+            if not args.application:
+                parser.error('--email requires --application')
+            password = sys.stdin.read().rstrip('\n')
+            dashclient = gae_dashboard_curl.DashboardClient(args.email,
+                                                            password)
+            csv_iter = dashclient.open('/billing/history.csv?app_id=%s'
+                                       % args.application)
+        else:
+            csv_iter = sys.stdin
+
+    # We hold the lock for the whole import, so if another run starts
+    # meanwhile it waits, then only imports what we didn't.
+    try:
+        with _LAST_RECORD_DB.locked():
+            import_usage_reports(csv_iter, args.graphite_host, args.verbose,
+                                 args.dry_run, args.incremental)
+    finally:
+        if dashclient:
+            dashclient.retry_policy.log_summary('load_usage_reports')
+
 
 if __name__ == "__main__":
-    main(sys.stdin)
+    main()
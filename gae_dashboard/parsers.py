@@ -3,7 +3,10 @@
 # Has a "debug mode" when __name__ == '__main__'. See the bottom of
 # the file for details.
 
+import functools
+from lxml import etree
 from lxml import html
+from lxml.cssselect import CSSSelector
 import re
 import sys
 
@@ -24,6 +27,57 @@ def text(html_element):
     return html_element.xpath("string()") or ''  # avoid returning None
 
 
+def _selector(css):
+    """Compile a CSS selector to an lxml XPath object.
+
+    element.cssselect(css) converts the CSS to XPath every time it is
+    called, so the parsers compile their selectors once, up front, and
+    call them like selector(element).
+    """
+    return CSSSelector(css, translator='html')
+
+
+def _memoize(method):
+    """Cache the result of a parser method that takes no arguments.
+
+    A parser's page never changes, so there's no need to re-run the
+    selectors and re-build the Values every time a method is called,
+    e.g. when gae_dashboard_scrape asks for both
+    instance_summary.summaries and instance_summary.summary.  Callers
+    share the returned object, so they should not modify it.
+    """
+    @functools.wraps(method)
+    def wrapper(self):
+        if method.__name__ not in self._memo:
+            self._memo[method.__name__] = method(self)
+        return self._memo[method.__name__]
+    return wrapper
+
+
+# The parsers read a number out of nearly every cell they look at, so
+# the patterns for that are compiled once, here.  _NUMBER_RE matches
+# digits with optional thousands separators and decimal part.
+_NUMBER_RE = re.compile(r'\d[\d,]*(?:\.\d+)?')
+
+# "3 day(s) 23 hour(s) 38 min(s) 16 second(s)", where each part is
+# optional but they must come in this order.  These are re.UNICODE so
+# that \s matches the u'\xa0' that lxml gives us for &nbsp;.
+_TIME_AGO_RE = re.compile(r'^\s*(?:(\d+)\s+day\(s\)\s*)?'
+                          r'(?:(\d+)\s+hour\(s\)\s*)?'
+                          r'(?:(\d+)\s+min\(s\)\s*)?'
+                          r'(?:(\d+)\s+second\(s\)\s*)?$', re.UNICODE)
+
+# "26:13:25", i.e. hours:minutes:seconds.
+_DURATION_RE = re.compile(r'^\s*(\d+):(\d\d):(\d\d)\s*$', re.UNICODE)
+
+# Used by BaseParser._truncate_after_id().  _ID_RES maps an element
+# id to a pattern for its id attribute, and _TAG_RES maps a tag name to
+# a pattern for its open and close tags, both compiled on first use.
+_TAG_NAME_RE = re.compile(r'<(\w+)')
+_ID_RES = {}
+_TAG_RES = {}
+
+
 def _to_num(val):
     """Return first numeric thing as float or int.
 
@@ -36,10 +90,12 @@ def _to_num(val):
       "1,234.56" -> 1234.56
 
     """
-    m = re.search(r'\d+(?:\.\d+)?', val.replace(',', ''))
+    m = _NUMBER_RE.search(val)
     if not m:
         raise ValueError('No number found in %s' % val)
     numstr = m.group(0)
+    if ',' in numstr:
+        numstr = numstr.replace(',', '')
     if '.' in numstr:
         return float(numstr)
     else:
@@ -55,14 +111,21 @@ class Value(object):
     This object retains both parts of the original value and provides
     class methods that make it easier to parse out the value portion
     from scraped HTML text.
+
+    Parsers may create many of these, so we use __slots__, and only
+    normalize the scraped text's whitespace if someone asks for it.
     """
+    __slots__ = ('_raw_text', '_value')
+
     def __init__(self, text, value):
-        self._text = self._normalize_html(text)
+        self._raw_text = text
         self._value = value
 
     def text(self):
-        """Scraped HTML text."""
-        return self._text
+        """Scraped HTML text, or None if the parser did not keep it."""
+        if self._raw_text is None:
+            return None
+        return self._normalize_html(self._raw_text)
 
     def value(self):
         """Value derived from the scraped HTML text."""
@@ -95,40 +158,119 @@ class Value(object):
     @classmethod
     def from_time_ago(cls, value_str):
         """Read "3 day(s) 23 hour(s) 38 min(s) 16 second(s)" as 344296."""
-        value_str = cls._normalize_html(value_str)
-        value_str = value_str + ' '  # add trailing space to simplify regex
+        match = _TIME_AGO_RE.match(value_str)
         # Only one of these time specifiers must be found.
-        pattern = (r'^(?:(\d+) day\(s\)\s+)?'
-                   r'(?:(\d+) hour\(s\)\s+)?'
-                   r'(?:(\d+) min\(s\)\s+)?'
-                   r'(?:(\d+) second\(s\)\s+)?$')
-        match = re.match(pattern, value_str)
         if not match or not any(match.groups()):
-            raise ValueError('%r did not match in %r' % (pattern, value_str))
-        seconds = 0
-        if match.group(4):
-            seconds += int(match.group(4))  # seconds
-        if match.group(3):
-            seconds += int(match.group(3)) * 60  # minutes
-        if match.group(2):
-            seconds += int(match.group(2)) * 60 * 60  # hours
-        if match.group(1):
-            seconds += int(match.group(1)) * 60 * 60 * 24  # days
-        return cls(value_str, seconds)
+            raise ValueError('%r did not match in %r'
+                             % (_TIME_AGO_RE.pattern, value_str))
+        (days, hours, minutes, seconds) = match.groups()
+        total = 0
+        if seconds:
+            total += int(seconds)
+        if minutes:
+            total += int(minutes) * 60
+        if hours:
+            total += int(hours) * 60 * 60
+        if days:
+            total += int(days) * 60 * 60 * 24
+        return cls(value_str, total)
+
+    @classmethod
+    def from_duration(cls, value_str):
+        """Read "26:13:25" (hours:minutes:seconds) as 94405."""
+        match = _DURATION_RE.match(value_str)
+        if not match:
+            raise ValueError('No h:mm:ss duration found in %r' % value_str)
+        (hours, minutes, seconds) = (int(g) for g in match.groups())
+        return cls(value_str, hours * 60 * 60 + minutes * 60 + seconds)
+
+
+class TextlessValue(Value):
+    """A Value that does not keep the scraped text, to save memory.
+
+    Parsers created with keep_text=False use this instead of Value.
+    """
+    __slots__ = ()
+
+    def __init__(self, text, value):
+        super(TextlessValue, self).__init__(None, value)
 
 
 class BaseParser(object):
     """A shared base class for common operations."""
 
-    def __init__(self, html_contents):
-        """Initialize with a string containing the dashboard page's HTML."""
+    # Subclasses that only need data from part of the page set this to
+    # the id of the element that contains it.  With fast=True, we don't
+    # parse the page past the end of that element.  This is only worth
+    # it if the element is well before the end of the page: otherwise
+    # finding its end costs more than parsing the rest of the page.
+    _LAST_NEEDED_ID = None
+
+    _APP_ID_SELECTOR = _selector(
+        '#ae-appbar-app-id option[selected="selected"]')
+
+    def __init__(self, html_contents, fast=False, keep_text=True):
+        """Initialize with a string containing the dashboard page's HTML.
+
+        If fast is True and the parser class supports it, only parse
+        the page up to the end of the part of it we need.
+
+        If keep_text is False, the Values we return don't keep the
+        scraped text (their .text() is None), only the parsed value.
+        """
+        self._value_class = Value if keep_text else TextlessValue
+        if fast and self._LAST_NEEDED_ID:
+            html_contents = self._truncate_after_id(html_contents,
+                                                    self._LAST_NEEDED_ID)
         self.doc = html.document_fromstring(html_contents)
+        self._memo = {}      # used by @_memoize
 
+    @staticmethod
+    def _truncate_after_id(html_contents, element_id):
+        """Cut html_contents off after the end of the element with this id.
+
+        lxml closes any tags left open, so parsing the result gives a
+        document with everything up to and including that element.  If
+        we can't find the element, we return html_contents unchanged.
+
+        We find the end of the element with a quick scan for its open
+        and close tags rather than with lxml.etree.iterparse(): that
+        creates a python object for every element it parses, which in
+        our benchmarks made it slower than just parsing the whole page.
+        """
+        id_re = _ID_RES.get(element_id)
+        if id_re is None:
+            # The whitespace before "id" keeps us from matching an
+            # attribute like data-id="...".
+            id_re = _ID_RES[element_id] = re.compile(
+                r'\sid\s*=\s*(["\']?)%s\1[\s/>]' % re.escape(element_id))
+        id_match = id_re.search(html_contents)
+        if not id_match:
+            return html_contents
+        start = html_contents.rfind('<', 0, id_match.start())
+        start_match = _TAG_NAME_RE.match(html_contents, start)
+        if not start_match:
+            return html_contents
+        tag_name = start_match.group(1).lower()
+        tag_re = _TAG_RES.get(tag_name)
+        if tag_re is None:
+            tag_re = _TAG_RES[tag_name] = re.compile(r'<(/?)%s\b' % tag_name,
+                                                     re.I)
+        depth = 0
+        for tag_match in tag_re.finditer(html_contents, start):
+            depth += -1 if tag_match.group(1) else 1
+            if depth == 0:
+                end = html_contents.find('>', tag_match.end())
+                if end == -1:
+                    return html_contents
+                return html_contents[:end + 1]
+        return html_contents
+
+    @_memoize
     def application_id(self):
-        selector = '#ae-appbar-app-id option[selected="selected"]'
         # There should be exactly one selected application id.
-        (app_id_element, ) = self.doc.cssselect(selector)
-        value = app_id_element['value']
+        (app_id_element, ) = self._APP_ID_SELECTOR(self.doc)
+        value = app_id_element.attrib['value']
         assert value.startswith('s~'), value
         return value[2:]
 
@@ -136,55 +278,118 @@ class BaseParser(object):
 class BillingHistory(BaseParser):
     """An API for the contents of /billing/history as structured data."""
 
-    def _usage_report_dict(self, root):
+    _EVENT_ROW_SELECTOR = _selector('#ae-billing-logs-table > tbody > tr')
+    _USAGE_ROW_SELECTOR = _selector('table > tbody > tr')
+
+    @classmethod
+    def _usage_report_dict(cls, root):
         """Extract usage report details from the element that contains
         the table with columns resource, unit, used."""
         details = {}
-        selector = 'table > tbody > tr'
-        for (resource, unit, used) in root.cssselect(selector):
+        for (resource, unit, used) in cls._USAGE_ROW_SELECTOR(root):
             name = resource.findtext('strong').strip()
             details[name] = (used.text.strip(), unit.text.strip())
         return details
 
-    def event_dicts(self):
-        """Information about each row in the billing history table.
-
-        Entries match the found in the HTML and have "date" and
-        "title" fields. If the event is a usage report, the key
-        "details" contains usage data. For example:
+    @classmethod
+    def _events_from_rows(cls, rows, cutoff_date=None):
+        """Yield an event dict (see event_dicts()) for the billing table rows.
 
-        {date: "2012-10-13 15:36:05",
-         title: "Usage Report for 2012-10-13",
-         details: {"Frontend Instance Hours": ('<X,XXX.XX>', 'Hour'),
-                   "Backend Instance Hours": ('<X,XXX.XX>', 'Hour'),
-                   ...}}
+        Each event is yielded once we've seen its details row, if it
+        has one.  If cutoff_date is given, we stop at the first event
+        from before that date.
         """
-        events = []
         # We're assuming that the table has alternating rows that
         # containg (date, event title) possibly followed by (<empty>,
         # event details).
-        selector = '#ae-billing-logs-table > tbody > tr'
-        for (date_elt, event_elt) in self.doc.cssselect(selector):
+        event = None
+        for (date_elt, event_elt) in rows:
             if date_elt.text is not None:
-                events.append({
+                if event is not None:
+                    yield event
+                event = {
                     # <td>EVENT DATE</td>
                     'date': date_elt.text.strip(),
                     # <td><span id="...">EVENT TITLE</span></td>
                     'title': event_elt.findtext('span').strip()
-                })
+                }
+                if cutoff_date and event['date'][:10] < cutoff_date:
+                    return
             else:
                 # An empty first column indicates details for the
                 # preceeding event.
-                assert len(events) > 0, len(events)
-                last_event = events[-1]
-                if last_event['title'].startswith('Usage Report '):
-                    last_event['details'] = self._usage_report_dict(event_elt)
-        return events
+                assert event is not None, rows
+                if event['title'].startswith('Usage Report '):
+                    event['details'] = cls._usage_report_dict(event_elt)
+                yield event
+                event = None
+        if event is not None:
+            yield event
+
+    @classmethod
+    def _iter_event_rows(cls, html_file):
+        """Yield the rows of the billing table as html_file is parsed.
+
+        Once the caller is done with a row, we throw it away, so only
+        a row at a time of the billing table is kept in memory.
+        """
+        for (_, row) in etree.iterparse(html_file, tag='tr', html=True):
+            # Skip header rows and the rows of the usage report tables.
+            tbody = row.getparent()
+            if tbody is None or tbody.tag != 'tbody':
+                continue
+            table = tbody.getparent()
+            if table is None or table.get('id') != 'ae-billing-logs-table':
+                continue
+            yield row
+            row.clear()
+            while row.getprevious() is not None:
+                del tbody[0]
+
+    @classmethod
+    def iter_event_dicts(cls, html_file, cutoff_date=None):
+        """Like event_dicts(), but reads the page a bit at a time.
+
+        Over a long billing history the page can be large, so this
+        parses it incrementally, yielding each event as soon as it's
+        been read and then throwing away its part of the page.
+
+        Arguments:
+          html_file: a file-like object with the page's HTML.
+          cutoff_date (optional): a string of the form 'YYYY-MM-DD'.
+            The billing table is newest-first, so we stop reading at
+            the first event whose date is before this one.  By
+            default, we read every event.
+
+        Returns:
+          An iterator over event dicts as described in event_dicts().
+        """
+        return cls._events_from_rows(cls._iter_event_rows(html_file),
+                                     cutoff_date)
+
+    @_memoize
+    def event_dicts(self):
+        """Information about each row in the billing history table.
+
+        Entries match the found in the HTML and have "date" and
+        "title" fields. If the event is a usage report, the key
+        "details" contains usage data. For example:
+
+        {date: "2012-10-13 15:36:05",
+         title: "Usage Report for 2012-10-13",
+         details: {"Frontend Instance Hours": ('<X,XXX.XX>', 'Hour'),
+                   "Backend Instance Hours": ('<X,XXX.XX>', 'Hour'),
+                   ...}}
+        """
+        return list(self._events_from_rows(
+            self._EVENT_ROW_SELECTOR(self.doc)))
 
 
 class Dashboard(BaseParser):
     """An API for the contents of /dashboard as structured data."""
 
+    _CHART_OPTION_SELECTOR = _selector('#chart option')
+
     def charts(self, time_span=None):
         """The labels and URLs of dashboard charts.
 
@@ -205,8 +410,7 @@ class Dashboard(BaseParser):
         URLs are not in the HTML of /dashboard on initial page load.
         """
         assert time_span in (None, '6 hrs', '12 hrs', '24 hrs'), time_span
-        selector = '#chart option'
-        for element in self.doc.cssselect(selector):
+        for element in self._CHART_OPTION_SELECTOR(self.doc):
             label = element.text.strip()
             chart_id = element.attrib['value']
             hidden_input = self.doc.get_element_by_id('ae-dash-graph-' +
@@ -223,6 +427,10 @@ class Dashboard(BaseParser):
 class InstanceSummary(BaseParser):
     """An API for the contents of /instance_summary as structured data."""
 
+    _LAST_NEEDED_ID = 'ae-content'
+    _ROW_SELECTOR = _selector('#ae-content tr')
+
+    @_memoize
     def summaries(self):
         """Performance statistics summarized by App Engine release.
 
@@ -242,9 +450,9 @@ class InstanceSummary(BaseParser):
 
         """
         summaries = []
-        selector = '#ae-content tr'
+        value_class = self._value_class
         # The table has multiple rows when a new version is rolling out.
-        rows = self.doc.cssselect(selector)
+        rows = self._ROW_SELECTOR(self.doc)
         for row in rows:
             children = list(row)
             # Expecting 'App Engine Release', 'Total number of instances',
@@ -256,16 +464,18 @@ class InstanceSummary(BaseParser):
             if appengine_release.lower() == 'unknown':
                 continue
             data = {
-                'appengine_release': Value.from_str(appengine_release),
-                'total_instances': Value.from_number(text(children[1])),
-                'average_qps': Value.from_number(text(children[2])),
-                'average_memory': Value.from_number(text(children[4])),
+                'appengine_release': value_class.from_str(appengine_release),
+                'total_instances': value_class.from_number(text(children[1])),
+                'average_qps': value_class.from_number(text(children[2])),
+                'average_memory': value_class.from_number(text(children[4])),
             }
             if text(children[3]).strip() != 'Unknown ms':
-                data['average_latency'] = Value.from_number(text(children[3]))
+                data['average_latency'] = value_class.from_number(
+                    text(children[3]))
             summaries.append(data)
         return summaries
 
+    @_memoize
     def summary(self):
         """Performance statistics summarized across all instances.
 
@@ -278,24 +488,31 @@ class InstanceSummary(BaseParser):
            'average_memory_mb': 134.8}
 
         """
-        summaries = self.summaries()
+        fields = ('average_qps', 'average_latency', 'average_memory')
         # Reduce to a single summary with weighted averages for each
-        # field except "total_instances", which is summed.
-        summary = {'total_instances': sum(d['total_instances'].value()
-                                          for d in summaries)}
-        for field in ('average_qps', 'average_latency', 'average_memory'):
-            # During rollout of a new SDK, average_latency may be unknown
-            # for a set of instances so we don't count it.
-            instance_weighted_sum = sum(
-                d['total_instances'].value() * d[field].value()
-                for d in summaries if field in d)
-            weight = sum(
-                d['total_instances'].value()
-                for d in summaries if field in d)
-            if instance_weighted_sum == 0 and weight == 0:
+        # field except "total_instances", which is summed.  We collect
+        # all the sums in one pass over the summaries.
+        total_instances = 0
+        instance_weighted_sums = dict.fromkeys(fields, 0)
+        weights = dict.fromkeys(fields, 0)
+        for d in self.summaries():
+            num_instances = d['total_instances'].value()
+            total_instances += num_instances
+            for field in fields:
+                # During rollout of a new SDK, average_latency may be
+                # unknown for a set of instances so we don't count it.
+                if field in d:
+                    instance_weighted_sums[field] += (num_instances *
+                                                      d[field].value())
+                    weights[field] += num_instances
+
+        summary = {'total_instances': total_instances}
+        for field in fields:
+            if instance_weighted_sums[field] == 0 and weights[field] == 0:
                 summary[field] = 0
             else:
-                summary[field] = float(instance_weighted_sum) / weight
+                summary[field] = (float(instance_weighted_sums[field]) /
+                                  weights[field])
         # Beautify rounding precision to match the App Engine UI.
         summary['average_qps'] = round(summary['average_qps'], 3)
         summary['average_latency_ms'] = round(summary['average_latency'], 1)
@@ -308,13 +525,18 @@ class InstanceSummary(BaseParser):
 class Instances(BaseParser):
     """An API for the contents of /instances as structured data."""
 
+    _VERSION_SELECTOR = _selector(
+        '#ae-appbar-version-id option[selected="selected"]')
+    _DETAIL_ROW_SELECTOR = _selector('#ae-instances-details-table tbody tr')
+
+    @_memoize
     def version(self):
         """The app version that owns these instances."""
-        selector = '#ae-appbar-version-id option[selected="selected"]'
         # There should be exactly one selected version.
-        (version_element, ) = self.doc.cssselect(selector)
+        (version_element, ) = self._VERSION_SELECTOR(self.doc)
         return version_element.text.strip()
 
+    @_memoize
     def raw_detail_dicts(self):
         """Performance statistics specific to each instance.
 
@@ -333,8 +555,7 @@ class Instances(BaseParser):
         """
         # TODO(chris): validate columns using column headers.
         details = []
-        selector = '#ae-instances-details-table tbody tr'
-        for element in self.doc.cssselect(selector):
+        for element in self._DETAIL_ROW_SELECTOR(self.doc):
             children = list(element)
             assert len(children) == 9, [child.text for child in children]
             details.append({
@@ -348,9 +569,52 @@ class Instances(BaseParser):
             })
         return details
 
+    @_memoize
+    def details(self):
+        """Like raw_detail_dicts(), but with the statistics parsed.
+
+        Returns:
+          A list of dicts with the same keys as raw_detail_dicts().
+          instance_id is a string; the other values are Value
+          instances whose .value() is a number, e.g.:
+
+          [{'instance_id': '01c61b117c08b2b562c94f26f43f9b04f6775180',
+            'qps': 1.183,
+
+            # The latency key may not be present.
+            'latency': 208.5,       # in ms
+            'requests': 14628,
+            'errors': 5,
+            'age': 32872,           # in seconds
+            'memory': 184.8},       # in MBytes
+           ...
+          ]
+        """
+        value_class = self._value_class
+        details = []
+        for raw in self.raw_detail_dicts():
+            data = {
+                'instance_id': raw['instance_id'],
+                'qps': value_class.from_number(raw['qps']),
+                'requests': value_class.from_number(raw['requests']),
+                'errors': value_class.from_number(raw['errors']),
+                'age': value_class.from_duration(raw['age']),
+                'memory': value_class.from_number(raw['memory']),
+            }
+            # As on /instance_summary, latency may not be known yet.
+            if raw['latency'] != 'Unknown ms':
+                data['latency'] = value_class.from_number(raw['latency'])
+            details.append(data)
+        return details
+
 
 class Memcache(BaseParser):
     """An API for the contents of /memcache as structured data."""
+
+    _LAST_NEEDED_ID = 'ae-stats-table'
+    _ROW_SELECTOR = _selector('#ae-stats-table tr')
+
+    @_memoize
     def statistics(self):
         """Memcache statistics for the current application.
 
@@ -369,16 +633,16 @@ class Memcache(BaseParser):
 
         """
         stats = {}
+        value_class = self._value_class
         fields = {
-            'Hit count:': ('hit_count', Value.from_number),
-            'Miss count:': ('miss_count', Value.from_number),
-            'Hit ratio:': ('hit_ratio', Value.from_percent),
-            'Item count:': ('item_count', Value.from_number),
-            'Total cache size:': ('total_cache_size', Value.from_number),
-            'Oldest item age:': ('oldest_item_age', Value.from_time_ago),
+            'Hit count:': ('hit_count', value_class.from_number),
+            'Miss count:': ('miss_count', value_class.from_number),
+            'Hit ratio:': ('hit_ratio', value_class.from_percent),
+            'Item count:': ('item_count', value_class.from_number),
+            'Total cache size:': ('total_cache_size', value_class.from_number),
+            'Oldest item age:': ('oldest_item_age', value_class.from_time_ago),
             }
-        selector = '#ae-stats-table tr'
-        for element in self.doc.cssselect(selector):
+        for element in self._ROW_SELECTOR(self.doc):
             children = list(element)
             assert len(children) == 2, [text(child) for child in children]
             if text(children[0]).strip() in fields:
@@ -397,6 +661,10 @@ class Memcache(BaseParser):
 class Deployment(BaseParser):
     """An API for the contents of /deployment as structured data."""
 
+    _LIVE_CLASS = 'ae-deployment-live'
+    _LIVE_SELECTOR = _selector('.' + _LIVE_CLASS)
+
+    @_memoize
     def default_version(self):
         """Default version as a string, e.g., "1"."""
         # Seen in 1.9.3 within the version table and only for the
@@ -406,13 +674,13 @@ class Deployment(BaseParser):
         # Yes
         # </strong>
         #
-        cssclass = 'ae-deployment-live'
-        elements = list(self.doc.cssselect('.' + cssclass))
+        cssclass = self._LIVE_CLASS
+        elements = self._LIVE_SELECTOR(self.doc)
         assert len(elements) == 1, elements
         child = elements[0]
         assert text(child).strip() == 'Yes', text(child)
         assert child.attrib['id'].startswith(cssclass), child.attrib['id']
-        return Value.from_str(child.attrib['id'][len(cssclass):])
+        return self._value_class.from_str(child.attrib['id'][len(cssclass):])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,132 @@
+"""Utility functions for keeping state, like high-water marks, between runs.
+
+Scripts like dashboard_report.py and load_usage_reports.py remember
+how far they've imported data (a time_t "high-water mark"), so the
+next run only imports newer data.  If that state is lost or corrupted,
+the next run re-imports everything, so we're careful with it:
+
+- State is written to a temp file that is renamed into place, so a
+  crash mid-write leaves the old state rather than a truncated file.
+- A run holds an exclusive lock (an flock on a .lock file next to the
+  state file) from when it reads the state until it's written it back,
+  so two overlapping cron runs don't import the same data or undo
+  each other's progress.
+- raise_high_water_marks() never moves a mark backwards.
+- A state file we can't parse is an error, not an empty state.
+
+State is stored as JSON.  Other files that must never be seen half
+written (caches, cookie files) can use atomic_replace() or write_file(),
+which write via a temp file and rename the same way.
+
+Usage:
+
+  state = state_util.State(os.path.join(os.getenv('HOME'), 'foo.db'))
+  with state.locked():
+      marks = state.read(default={})
+      ...import the data newer than marks...
+      state_util.raise_high_water_marks(marks, {'some_key': time_t})
+      state.write(marks)
+"""
+
+import contextlib
+import errno
+import fcntl
+import json
+import os
+import threading
+
+
+class State(object):
+    """A JSON value stored in a file."""
+    def __init__(self, path):
+        """path: the file to store the state in; usually under $HOME."""
+        self.path = path
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Hold an exclusive lock on this state, waiting for it if need be.
+
+        The lock is advisory: it only keeps out other processes that
+        also use locked().
+        """
+        with open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield self
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read(self, default=None):
+        """Return the stored state, or default if none has been stored."""
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except IOError, why:
+            if why.errno == errno.ENOENT:
+                return default
+            raise
+
+    def write(self, value):
+        """Store value, which must be JSON-serializable, atomically."""
+        write_file(self.path, json.dumps(value, indent=2, sort_keys=True))
+
+
+@contextlib.contextmanager
+def atomic_replace(path, private=False):
+    """Replace the file at path, so readers never see it half-written.
+
+    This yields the name of a temp file to write the new contents to.
+    When the with block ends, the temp file is fsync'ed and renamed to
+    path.  If the block raises, the temp file is removed and path is
+    left alone.  The temp file's name is unique to this process and
+    thread, so concurrent writers don't clobber each other's (the last
+    rename wins).
+
+    If private is True, the file is only readable by us.
+    """
+    tmpfile = '%s.tmp.%s.%s' % (path, os.getpid(),
+                                threading.current_thread().ident)
+    try:
+        os.close(os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0600 if private else 0666))
+        yield tmpfile
+        fd = os.open(tmpfile, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(tmpfile, path)
+    except:
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+        raise
+
+
+def write_file(path, contents, private=False):
+    """Atomically replace the file at path with the string contents.
+
+    See atomic_replace() for what private means.
+    """
+    with atomic_replace(path, private) as tmpfile:
+        with open(tmpfile, 'wb') as f:
+            f.write(contents)
+
+
+def raise_high_water_marks(marks, new_marks):
+    """Update marks with new_marks, but never move a mark backwards.
+
+    Arguments:
+      marks: a dict mapping keys to high-water marks (e.g. time_t's),
+        or to dicts of the same form, e.g. module -> chart -> time_t.
+        It's modified in place.
+      new_marks: a dict of the same form with the marks to raise.
+
+    Returns:
+      marks.
+    """
+    for (key, new_mark) in new_marks.iteritems():
+        if isinstance(new_mark, dict):
+            raise_high_water_marks(marks.setdefault(key, {}), new_mark)
+        elif key not in marks or new_mark > marks[key]:
+            marks[key] = new_mark
+    return marks